@@ -1,14 +1,44 @@
-from fastapi import FastAPI, HTTPException, Query, UploadFile, File, Depends
+from fastapi import FastAPI, HTTPException, Query, UploadFile, File, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pymongo.errors import BulkWriteError
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from typing import List
 import os
-import uuid
-from ilo import preprocess
-from importing import import_story
+import asyncio
+import base64
+import zlib
+import json
+import orjson
+from ilo import ascii_to_ucsur, is_ucsur
+from tokencache import content_hash, token_cache
+from rendering import MEDIA_TYPES, SITELEN_FONT, render_cache
+from responsecache import etag_matches, response_cache
+from images import (
+    ImageTooLarge,
+    InvalidImage,
+    get_variant,
+    image_path,
+    save_upload,
+    variant_width,
+)
+from serialization import DocumentEncoder
+from importing import (
+    import_story,
+    pack_tokens,
+    preprocess_stories_async,
+    stored_tokens,
+    tokenize_contents,
+)
+from workers import PoolSaturated, TaskTimeout, tokenize_pool
+from jobs import IngestQueue
+from instances import REGISTRY_COLLECTION, InstanceRegistry
+from corpus import stories_added, stories_removed
+from search import search_indexes, search_stories
+from readable import coverage_indexes, readable_stories
+from related import RELATED_COUNT, related_indexes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
 from datetime import datetime, timedelta, UTC
@@ -22,6 +52,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["X-Next-Cursor"],
 )
 
 # MongoDB connection
@@ -49,13 +80,90 @@ async def verify_jwt(credentials: HTTPAuthorizationCredentials = Depends(securit
         )
 
 
-def get_collection(instance: str = "default"):
-    if instance == "default" or instance == "localhost":
-        return db["stories"]  # Use original collection for default instance
-    
-    # For other instances, use instance-specific collections
-    safe_instance = "".join(c for c in instance if c.isalnum() or c in ('-', '_')).lower()
-    return db[f"{safe_instance}"]
+# Instance collection names never contain a dot, so this can't clash with one
+JOBS_COLLECTION = "jobs.ingest"
+registry = InstanceRegistry(db, db[REGISTRY_COLLECTION])
+
+
+async def get_instance(instance: str = "default", create: bool = False):
+    """
+    Returns a registered instance, or with create set up a new one.
+
+    Raises a 404 for instances that were never written to, rather than reading
+    an empty collection.
+    """
+    if create:
+        try:
+            return await registry.ensure(instance)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    found = await registry.get(instance)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Instance not found")
+    return found
+
+
+async def get_collection(instance: str = "default"):
+    return (await get_instance(instance)).collection
+
+
+ingest_queue = IngestQueue(db[JOBS_COLLECTION], lambda name: registry.ensure(name))
+
+
+@app.on_event("startup")
+async def load_instances():
+    # Collections from before the registry are registered on first start
+    names = [name for name in await db.list_collection_names() if "." not in name]
+    await registry.load(["stories", *names])
+
+
+@app.on_event("startup")
+async def start_ingest():
+    await ingest_queue.ensure_indexes()
+    ingest_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    await ingest_queue.stop()
+    tokenize_pool.shutdown()
+
+
+@app.exception_handler(PoolSaturated)
+async def pool_saturated(request: Request, exc: PoolSaturated):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(TaskTimeout)
+async def task_timeout(request: Request, exc: TaskTimeout):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+def encode_cursor(story: dict) -> str:
+    """Returns an opaque token for the position of a story in the feed"""
+    date = story.get("date")
+    position = {"date": date.isoformat() if date else None, "id": str(story["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip("=")
+
+
+def cursor_query(token: str) -> dict:
+    """Returns the query for the stories after a cursor, in feed order"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        story_id = ObjectId(position["id"])
+        date = datetime.fromisoformat(position["date"]) if position["date"] else None
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if date is None:
+        # Undated stories sort last
+        return {"date": None, "_id": {"$lt": story_id}}
+    return {
+        "$or": [
+            {"date": {"$lt": date}},
+            {"date": date, "_id": {"$lt": story_id}},
+            {"date": None},
+        ]
+    }
 
 class PyObjectId(ObjectId):
     @classmethod
@@ -108,111 +216,594 @@ class Story(BaseModel):
         }
 
 
+class StorySummary(BaseModel):
+    """The fields a feed listing shows, without the content or its tokens"""
+    id: str | None = None
+    title: str
+    summary: str | None = None
+    imageUrl: str | None = None
+    author: str | None = None
+    date: datetime | None = None
+    originalLink: str | None = None
+
+    class Config:
+        json_encoders = Story.Config.json_encoders
+
+
+# Fields fetched from MongoDB for each view of the feed; None fetches everything
+VIEW_PROJECTIONS = {
+    "full": None,
+    "summary": {field: 1 for field in StorySummary.model_fields if field != "id"},
+}
+VIEW_MODELS = {"full": Story, "summary": StorySummary}
+# Reads skip the models and encode documents directly; only writes are validated
+VIEW_ENCODERS = {view: DocumentEncoder(model) for view, model in VIEW_MODELS.items()}
+# Accept type asking for tokenised as base64 ilo.encode_tokens output
+COMPACT_TOKENS_TYPE = "application/vnd.akesi.compact-tokens+json"
+
+
+def token_format(request: Request, tokens: str | None) -> str:
+    """Picks the token shape from the tokens parameter, then the Accept header"""
+    if tokens is not None:
+        return tokens
+    if COMPACT_TOKENS_TYPE in request.headers.get("accept", ""):
+        return "compact"
+    return "legacy"
+
+
+def story_response(story: dict) -> Story:
+    """Builds the Story a write endpoint returns from a stored document"""
+    return Story(
+        id=str(story["_id"]),
+        **{k: v for k, v in story.items() if k not in ("_id", "tokenised")},
+        tokenised=stored_tokens(story),
+    )
+
+
+async def summaries_by_id(collection, ids: list) -> dict:
+    """Fetches the summary view of stories, keyed by id"""
+    return {
+        story["_id"]: story
+        async for story in collection.find({"_id": {"$in": ids}}, VIEW_PROJECTIONS["summary"])
+    }
+
+
+async def cached_response(request: Request, namespace: str, build, vary=()):
+    """
+    Serves a JSON response from the response cache, calling build on a miss.
+
+    build is awaited and returns the body bytes and any extra headers. Responses
+    carry a strong ETag, and a matching If-None-Match gets a 304. vary holds
+    anything besides the path and query that the body depends on.
+    """
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())), *vary)
+    generation = response_cache.generation(namespace)
+    entry = response_cache.get(namespace, key)
+    if entry is None:
+        body, headers = await build()
+        entry = response_cache.put(namespace, key, body, headers, generation)
+    etag, body, headers = entry
+    headers = {**headers, "ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 
 app.get("/")
 async def root():
     return {"message": "See /stories for all stories"}
 
 
-@app.get("/stories", response_model=List[Story])
+@app.get("/stories", response_model=List[Story] | List[StorySummary])
 async def get_stories(
+    request: Request,
     skip: int = Query(0, ge=0, description="Number of stories to skip"),
     limit: int = Query(100, ge=1, le=100, description="Number of stories to return"),
     instance: str = Query("default", description="Instance identifier"),
+    after: str | None = Query(None, description="X-Next-Cursor from the previous page, instead of skip"),
+    view: str = Query("full", pattern="^(full|summary)$", description="summary leaves out content and tokens"),
+    tokens: str | None = Query(None, pattern="^(legacy|compact)$", description="Shape of tokenised"),
 ):
-    collection = get_collection(instance)
-    stories = await collection.find().sort([
-        ("date", -1),
-        ("_id", -1)
-    ]).skip(skip).limit(limit).to_list(limit)
-    return [
-        Story(id=str(story["_id"]), **{k: v for k, v in story.items() if k != "_id"})
-        for story in stories
-    ]
+    collection = await get_collection(instance)
+    format = token_format(request, tokens)
+
+    async def build():
+        query = cursor_query(after) if after else {}
+        stories = await collection.find(query, VIEW_PROJECTIONS[view]).sort([
+            ("date", -1),
+            ("_id", -1)
+        ]).skip(skip).limit(limit).to_list(limit)
+        headers = {"Vary": "Accept"}
+        if len(stories) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(stories[-1])
+        return VIEW_ENCODERS[view].encode_many(stories, format), headers
+
+    return await cached_response(request, collection.name, build, (format,))
+
+
+# Stories fetched from MongoDB per round trip while exporting
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 500))
+
+
+async def export_lines(cursor, format: str, compress: bool):
+    """Yields a cursor's stories as NDJSON, a cursor batch at a time"""
+    encoder = VIEW_ENCODERS["full"]
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    lines = []
+    async for story in cursor:
+        lines.append(orjson.dumps(encoder.document(story, format)) + b"\n")
+        if len(lines) == EXPORT_BATCH_SIZE:
+            chunk = b"".join(lines)
+            lines = []
+            if compressor is not None:
+                chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield chunk
+    chunk = b"".join(lines)
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    yield chunk
+
+
+@app.get("/stories/export")
+async def export_stories(
+    request: Request,
+    instance: str = Query("default", description="Instance identifier"),
+    since: datetime | None = Query(None, description="Only stories dated at or after this"),
+    tokens: str | None = Query(None, pattern="^(legacy|compact)$", description="Shape of tokenised"),
+):
+    """
+    Streams every story of an instance as NDJSON, oldest first, gzipped if the
+    client accepts it. For incremental syncs, pass the date of the last story
+    received as since; stories dated exactly then are sent again.
+    """
+    collection = await get_collection(instance)
+    query = {"date": {"$gte": since}} if since is not None else {}
+    cursor = collection.find(query).sort([("date", 1), ("_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    compress = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        export_lines(cursor, token_format(request, tokens), compress),
+        media_type="application/x-ndjson",
+        headers=headers,
+    )
+
+
+@app.get("/stories/readable")
+async def get_readable_stories(
+    request: Request,
+    known: str = Query(..., description="Words the learner knows, separated by commas or spaces"),
+    min_coverage: float = Query(0.9, ge=0, le=1, description="Least share of a story's words to know"),
+    instance: str = Query("default", description="Instance identifier"),
+    skip: int = Query(0, ge=0, description="Number of stories to skip"),
+    limit: int = Query(20, ge=1, le=100, description="Number of stories to return"),
+):
+    """
+    Lists the stories a learner can read, as summaries with the share of their
+    words the learner knows, most readable first. Names don't count as words,
+    and words outside the lexicon are never known.
+    """
+    found = await get_instance(instance)
+
+    async def build():
+        words = known.replace(",", " ").split()
+        total, page = await readable_stories(found, words, min_coverage, skip, limit)
+        stories = await summaries_by_id(found.collection, [story_id for story_id, _, _ in page])
+        results = []
+        for story_id, coverage, word_count in page:
+            if story_id in stories:
+                results.append({
+                    **VIEW_ENCODERS["summary"].document(stories[story_id]),
+                    "coverage": coverage,
+                    "words": word_count,
+                })
+        return orjson.dumps({"total": total, "results": results}), {}
+
+    return await cached_response(request, found.collection.name, build)
 
 
 @app.get("/stories/{story_id}", response_model=Story)
-async def get_story(story_id: str):
-    story = await stories_collection.find_one({"_id": ObjectId(story_id)})
-    if story:
-        return Story(
-            id=str(story["_id"]), **{k: v for k, v in story.items() if k != "_id"}
-        )
-    raise HTTPException(status_code=404, detail="Story not found")
+async def get_story(
+    request: Request,
+    story_id: str,
+    instance: str = Query("default", description="Instance identifier"),
+    tokens: str | None = Query(None, pattern="^(legacy|compact)$", description="Shape of tokenised"),
+):
+    stories_collection = await get_collection(instance)
+    format = token_format(request, tokens)
+
+    async def build():
+        story = await stories_collection.find_one({"_id": ObjectId(story_id)})
+        if story:
+            return VIEW_ENCODERS["full"].encode(story, format), {"Vary": "Accept"}
+        raise HTTPException(status_code=404, detail="Story not found")
+
+    return await cached_response(request, stories_collection.name, build, (format,))
+
+
+@app.get("/stories/{story_id}/related")
+async def get_related_stories(
+    request: Request,
+    story_id: str,
+    instance: str = Query("default", description="Instance identifier"),
+    limit: int = Query(RELATED_COUNT, ge=1, le=RELATED_COUNT, description="Number of stories to return"),
+):
+    """Lists the stories most like a story, as summaries with their similarity, most alike first"""
+    found = await get_instance(instance)
+
+    async def build():
+        related = await related_indexes.related(found, ObjectId(story_id)) if ObjectId.is_valid(story_id) else None
+        if related is None:
+            raise HTTPException(status_code=404, detail="Story not found")
+        related = related[:limit]
+        stories = await summaries_by_id(found.collection, [related_id for related_id, _ in related])
+        results = []
+        for related_id, score in related:
+            if related_id in stories:
+                results.append({**VIEW_ENCODERS["summary"].document(stories[related_id]), "score": score})
+        return orjson.dumps(results), {}
+
+    return await cached_response(request, found.collection.name, build)
 
 
 @app.post("/stories/tokenise", response_model=Story)
-async def tokenise_story(story: Story):
+async def tokenise_story(
+    story: Story,
+    token_payload: dict = Depends(verify_jwt),
+):
+    found = await get_instance(token_payload.get("instance", "stories"), create=True)
+    stories_collection = found.collection
     story_dict = story.dict(exclude={"id"})
-    story_dict["tokenised"] = preprocess(story_dict["content"])
+    story_dict["content_hash"] = content_hash(story_dict["content"])
+    story_dict["tokenizer_version"] = found.lexicon.version
+    story_dict["tokenised"] = pack_tokens(
+        (await tokenize_contents([story_dict["content"]], found.lexicon))[0], story_dict["content"]
+    )
     new_story = await stories_collection.insert_one(story_dict)
+    response_cache.invalidate(stories_collection.name)
     created_story = await stories_collection.find_one({"_id": new_story.inserted_id})
-    return Story(
-        id=str(created_story["_id"]),
-        **{k: v for k, v in created_story.items() if k != "_id"},
-    )
+    stories_added(stories_collection.name, [created_story])
+    return story_response(created_story)
+
+
+def job_response(job: dict) -> dict:
+    return {
+        "id": str(job["_id"]),
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "story_id": str(job["story_id"]),
+        "error": job.get("error"),
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    }
 
 
 @app.post("/stories", response_model=Story)
 async def create_story(
     story: Story,
+    background: bool = Query(False, description="Queue the story and return 202 with a job"),
     token_payload: dict = Depends(verify_jwt) 
 ):
     story_dict = story.model_dump(exclude={"id"})
     instance_name = token_payload.get("instance", "stories")
-    stories_collection= get_collection(instance = instance_name)
-    created_story = await import_story([story_dict], summarize=True)
+    instance = await get_instance(instance_name, create=True)
+    if background:
+        job = await ingest_queue.enqueue(instance_name, story_dict, summarize=True)
+        return JSONResponse(
+            status_code=202,
+            content=job_response(job),
+            headers={"Location": f"/jobs/{job['_id']}"},
+        )
+    created_story = await import_story(
+        [story_dict], instance.collection, summarize=True, lexicon=instance.lexicon
+    )
     print(f"{instance_name}: CREATED  ", str(created_story['_id']))
-    return Story(
-        id=str(created_story["_id"]),
-        **{k: v for k, v in created_story.items() if k != "_id"},
+    return story_response(created_story)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, token_payload: dict = Depends(verify_jwt)):
+    job = await ingest_queue.get(ObjectId(job_id)) if ObjectId.is_valid(job_id) else None
+    # Jobs are only visible to the instance that queued them
+    if job is None or job["instance"] != token_payload.get("instance", "stories"):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+
+# Stories tokenized and inserted together by POST /stories/bulk
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 100))
+
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc'])}: {e['msg']}" for e in error.errors()
+    )
+
+
+def parse_bulk_item(item) -> dict:
+    """Validates one story of a bulk upload into the document to insert"""
+    if not isinstance(item, dict):
+        raise ValueError("Expected a story object")
+    try:
+        return Story(**item).model_dump(exclude={"id"})
+    except ValidationError as e:
+        raise ValueError(validation_message(e))
+
+
+async def insert_bulk(instance, items: list, summarize: bool):
+    """
+    Tokenizes and inserts bulk upload items a batch at a time.
+
+    Args:
+        items (list): (index, story document or error message) pairs.
+
+    Yields:
+        bytes: An NDJSON line per item, with its index and its id or error.
+    """
+    for start in range(0, len(items), BULK_BATCH_SIZE):
+        batch = items[start : start + BULK_BATCH_SIZE]
+        results = {index: {"index": index, "error": item} for index, item in batch if isinstance(item, str)}
+        indexes = [index for index, story in batch if not isinstance(story, str)]
+        stories = [story for _, story in batch if not isinstance(story, str)]
+        if stories:
+            try:
+                stories = await preprocess_stories_async(stories, summarize, instance.lexicon)
+            except (PoolSaturated, TaskTimeout) as e:
+                for index in indexes:
+                    results[index] = {"index": index, "error": str(e)}
+                stories = []
+        if stories:
+            failed = {}
+            try:
+                await instance.collection.insert_many(stories, ordered=False)
+            except BulkWriteError as e:
+                failed = {error["index"]: error["errmsg"] for error in e.details["writeErrors"]}
+            response_cache.invalidate(instance.collection.name)
+            stories_added(
+                instance.collection.name,
+                [story for position, story in enumerate(stories) if position not in failed],
+            )
+            for position, (index, story) in enumerate(zip(indexes, stories)):
+                if position in failed:
+                    results[index] = {"index": index, "error": failed[position]}
+                else:
+                    results[index] = {"index": index, "id": str(story["_id"])}
+        for index, _ in batch:
+            yield orjson.dumps(results[index]) + b"\n"
+
+
+@app.post("/stories/bulk")
+async def create_stories(
+    request: Request,
+    summarize: bool = Query(False, description="Regenerate summaries even if given"),
+    token_payload: dict = Depends(verify_jwt),
+):
+    """
+    Creates many stories from a JSON array, or from NDJSON with an
+    application/x-ndjson content type.
+
+    Stories are validated one by one, so a bad story fails alone. Responds with
+    an NDJSON line per story, in order, holding its index and its new id or an
+    error, streamed as each batch is inserted.
+    """
+    instance_name = token_payload.get("instance", "stories")
+    instance = await get_instance(instance_name, create=True)
+    if tokenize_pool.saturated:
+        raise PoolSaturated("Too many tasks waiting for a worker")
+
+    items = []
+
+    def add(item):
+        try:
+            items.append((len(items), parse_bulk_item(item)))
+        except ValueError as e:
+            items.append((len(items), str(e)))
+
+    def add_line(line: bytes):
+        try:
+            item = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            items.append((len(items), "Invalid JSON"))
+            return
+        add(item)
+
+    if "ndjson" in request.headers.get("content-type", ""):
+        # Parsed as it arrives, so the raw body is never held in full
+        buffer = b""
+        async for chunk in request.stream():
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                if line.strip():
+                    add_line(line)
+        if buffer.strip():
+            add_line(buffer)
+    else:
+        try:
+            body = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of stories")
+        for item in body:
+            add(item)
+
+    print(f"{instance_name}: BULK  {len(items)} stories")
+    return StreamingResponse(
+        insert_bulk(instance, items, summarize), media_type="application/x-ndjson"
     )
 
 
+def _token_dicts(tokens: list) -> list:
+    # Tokens as the API reads them, for comparing sent tokens with the tokenizer's
+    return [TokenizedText.model_validate(token).model_dump(exclude_none=True) for token in tokens]
+
+
 @app.put("/stories/{story_id}", response_model=Story)
-async def update_story(story_id: str, story: Story):
+async def update_story(
+    story_id: str,
+    story: Story,
+    token_payload: dict = Depends(verify_jwt),
+):
+    found = await get_instance(token_payload.get("instance", "stories"))
+    stories_collection = found.collection
+    update = story.dict(exclude={"id"}, exclude_unset=True)
+    # The hash always describes the content, so other processes see the edit
+    update["content_hash"] = content_hash(update["content"])
+    tokenised = (await tokenize_contents([update["content"]], found.lexicon))[0]
+    sent = update.get("tokenised")
+    unset = {}
+    if sent is None or _token_dicts(sent) == _token_dicts(tokenised):
+        update["tokenizer_version"] = found.lexicon.version
+        update["tokenised"] = tokenised
+    else:
+        # Tokens of the client's own aren't this tokenizer's, so never reused as current
+        unset["tokenizer_version"] = ""
+    # Compact tokens point into the content, so they must follow it
+    update["tokenised"] = pack_tokens(update["tokenised"], update["content"])
     updated_story = await stories_collection.find_one_and_update(
         {"_id": ObjectId(story_id)},
-        {"$set": story.dict(exclude={"id"}, exclude_unset=True)},
+        {"$set": update, **({"$unset": unset} if unset else {})},
         return_document=True,
     )
     if updated_story:
-        return Story(
-            id=str(updated_story["_id"]),
-            **{k: v for k, v in updated_story.items() if k != "_id"},
-        )
+        response_cache.invalidate(stories_collection.name)
+        stories_added(stories_collection.name, [updated_story])
+        return story_response(updated_story)
     raise HTTPException(status_code=404, detail="Story not found")
 
 
 @app.delete("/stories/{story_id}")
-async def delete_story(story_id: str):
+async def delete_story(
+    story_id: str,
+    token_payload: dict = Depends(verify_jwt),
+):
+    stories_collection = await get_collection(token_payload.get("instance", "stories"))
     delete_result = await stories_collection.delete_one({"_id": ObjectId(story_id)})
     if delete_result.deleted_count == 1:
+        response_cache.invalidate(stories_collection.name)
+        stories_removed(stories_collection.name, [ObjectId(story_id)])
         return {"message": "Story deleted successfully"}
     raise HTTPException(status_code=404, detail="Story not found")
 
 
+@app.get("/search")
+async def search(
+    request: Request,
+    q: str = Query(..., min_length=1, description='Words to find; OR between alternatives, "a phrase", [Name]'),
+    instance: str = Query("default", description="Instance identifier"),
+    skip: int = Query(0, ge=0, description="Number of results to skip"),
+    limit: int = Query(20, ge=1, le=100, description="Number of results to return"),
+):
+    """
+    Finds the stories using words and names, best match first, as summaries
+    with their scores.
+    """
+    found = await get_instance(instance)
+
+    async def build():
+        total, page = await search_stories(found, q, skip, limit)
+        stories = await summaries_by_id(found.collection, [story_id for story_id, _ in page])
+        results = []
+        for story_id, score in page:
+            if story_id in stories:
+                results.append({**VIEW_ENCODERS["summary"].document(stories[story_id]), "score": score})
+        return orjson.dumps({"total": total, "results": results}), {}
+
+    return await cached_response(request, found.collection.name, build)
+
+
+@app.get("/instances")
+async def get_instances():
+    """Lists every instance with its number of stories and its sizes in bytes"""
+    return await registry.stats()
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "tokens": token_cache.stats(),
+        "renders": render_cache.stats(),
+        "responses": response_cache.stats(),
+        "tokenize_pool": tokenize_pool.stats(),
+        "ingest": ingest_queue.stats(),
+        "search": search_indexes.stats(),
+        "coverage": coverage_indexes.stats(),
+        "related": related_indexes.stats(),
+    }
+
+
+@app.get("/render")
+async def render(
+    request: Request,
+    text: str = Query(..., max_length=500, description="toki pona, in ascii or UCSUR"),
+    ascii: bool = Query(False, description="Caption the image with the ascii text"),
+    color: str = Query("black", description="Text colour"),
+    background: str = Query("white", description='Background colour, or "none"'),
+    size: int = Query(60, ge=8, le=200, description="Font size"),
+    padding: int = Query(20, ge=0, le=200, description="Padding around the text"),
+    format: str = Query("png", pattern="^(png|webp)$", description="Image format"),
+):
+    if SITELEN_FONT is None:
+        raise HTTPException(status_code=503, detail="No sitelen pona font configured")
+    sitelen = text if is_ucsur(text) else ascii_to_ucsur(text)
+    options = {
+        "ascii": ascii,
+        "stroke_color": color,
+        "background_color": None if background == "none" else background,
+        "font_size": size,
+        "padding": (padding, padding),
+    }
+
+    # Renders are content addressed, so a matching ETag never needs rendering
+    etag = f'"{render_cache.key(sitelen, format, **options)}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        _, data = await asyncio.to_thread(render_cache.render, sitelen, format, **options)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=data, media_type=MEDIA_TYPES[format], headers=headers)
+
+
 @app.put("/images", response_model=dict)
 async def upload_image(
     file: UploadFile = File(...),
     token_payload: dict = Depends(verify_jwt)  
 ):
-    file_extension = os.path.splitext(file.filename)[1]
-    new_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(IMAGE_UPLOAD_DIR, new_filename)
-
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
-
-    return {"image_id": new_filename}
+    try:
+        return await save_upload(file, IMAGE_UPLOAD_DIR)
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/images/{image_id}")
-async def get_image(image_id: str):
-    file_path = os.path.join(IMAGE_UPLOAD_DIR, image_id)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    raise HTTPException(status_code=404, detail="Image not found")
+async def get_image(
+    request: Request,
+    image_id: str,
+    w: int | None = Query(None, ge=1, description="Serve a WebP variant at least this wide"),
+):
+    file_path = image_path(IMAGE_UPLOAD_DIR, image_id)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    etag = f'"{image_id}"'
+    if w is not None:
+        width = variant_width(w)
+        variant = await get_variant(IMAGE_UPLOAD_DIR, image_id, width)
+        if variant is not None:
+            file_path = variant
+            etag = f'"{image_id}-{width}.webp"'
+    # Image ids never name different content, so their files never change
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(file_path, headers=headers)
 
 
 
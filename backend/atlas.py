@@ -0,0 +1,162 @@
+import functools
+import io
+import os
+import re
+
+from PIL import Image, ImageColor, ImageDraw
+
+from fontindex import get_index
+from ilo import ASCII_FONT, ASCII_TO_SITELEN, JOINERS, load_font
+
+SITELEN_FONT = os.environ.get("SITELEN_FONT")
+# Fonts tried in order for characters the sitelen pona font has no glyph for
+FALLBACK_FONTS = os.environ.get("FALLBACK_FONTS", ASCII_FONT).split(os.pathsep)
+
+# Glyphs rasterised up front: every sitelen pona glyph and common punctuation
+ATLAS_CHARACTERS = sorted(set(ASCII_TO_SITELEN.values())) + list(" .,!?:;\"'()-")
+# Places a line may break: whitespace, after a sitelen pona glyph (with any joined
+# glyphs and trailing punctuation), or after a run of other text
+UNIT_RE = re.compile(
+    "[\U000F1900-\U000F19FF](?:[%s][\U000F1900-\U000F19FF])*[.,!?:;]*|\\s+|[^\\s\U000F1900-\U000F19FF]+"
+    % "".join(JOINERS.values())
+)
+
+
+class Glyph:
+    __slots__ = ("mask", "offset", "advance")
+
+    def __init__(self, mask: Image.Image, offset: tuple, advance: float):
+        self.mask = mask
+        self.offset = offset
+        self.advance = advance
+
+
+class GlyphAtlas:
+    """
+    Glyph masks for a chain of fonts at one size, each rasterised once into an
+    image of its own that is pasted straight from. Each character is drawn with
+    the first font in the chain that has a glyph for it.
+
+    Masks are greyscale coverage, so one atlas serves every colour. Characters
+    outside ATLAS_CHARACTERS are rasterised the first time they are drawn.
+    """
+
+    def __init__(self, font_paths: tuple, font_size: int):
+        self.font_paths = font_paths
+        self.fonts = {path: load_font(path, font_size) for path in font_paths}
+        self.index = get_index(font_paths)
+        ascent, descent = self.fonts[font_paths[0]].getmetrics()
+        self.line_height = ascent + descent
+        self.glyphs = {}
+
+        for char in ATLAS_CHARACTERS:
+            self.glyphs[char] = Glyph(*self._rasterise(char))
+
+    def _rasterise(self, char: str) -> tuple:
+        font = self.fonts[self.index.font_for(char) or self.font_paths[0]]
+        bbox = font.getbbox(char)
+        mask = Image.new("L", (max(1, bbox[2] - bbox[0]), max(1, bbox[3] - bbox[1])))
+        ImageDraw.Draw(mask).text((-bbox[0], -bbox[1]), char, fill=255, font=font)
+        return mask, (bbox[0], bbox[1]), font.getlength(char)
+
+    def glyph(self, char: str) -> Glyph:
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = Glyph(*self._rasterise(char))
+            self.glyphs[char] = glyph
+        return glyph
+
+    def width(self, text: str) -> float:
+        return sum(self.glyph(char).advance for char in text)
+
+    def wrap(self, text: str, max_width: int = None) -> list:
+        """Splits text into lines no wider than max_width, breaking between units"""
+        lines = []
+        for paragraph in text.split("\n"):
+            line, x = [], 0
+            for unit in UNIT_RE.findall(paragraph):
+                width = self.width(unit)
+                if max_width is not None and line and x + width > max_width and not unit.isspace():
+                    lines.append("".join(line).rstrip())
+                    line, x = [], 0
+                if not line and unit.isspace():
+                    continue
+                line.append(unit)
+                x += width
+            lines.append("".join(line).rstrip())
+        return lines
+
+    def draw(self, image: Image.Image, position: tuple, line: str, fill):
+        """Blits a single line of text onto an image"""
+        x, y = position
+        for char in line:
+            glyph = self.glyph(char)
+            left = round(x) + glyph.offset[0]
+            top = y + glyph.offset[1]
+            image.paste(fill, (left, top, left + glyph.mask.width, top + glyph.mask.height), glyph.mask)
+            x += glyph.advance
+
+
+@functools.lru_cache(maxsize=16)
+def get_atlas(font_path: str, font_size: int) -> GlyphAtlas:
+    fallbacks = [path for path in FALLBACK_FONTS if path and path != font_path and os.path.exists(path)]
+    return GlyphAtlas((font_path, *fallbacks), font_size)
+
+
+def render_page(
+    sitelen: str,
+    font_path: str = SITELEN_FONT,
+    font_size: int = 60,
+    max_width: int = None,
+    stroke_color: str = "black",
+    background_color: str = "white",
+    padding: tuple = None,
+) -> Image.Image:
+    """
+    Composes sitelen pona text into an image from the glyph atlas.
+
+    Args:
+        sitelen (str): UCSUR text, may contain newlines.
+        font_path (str, optional): Path to the sitelen pona font file. Required if not set as default.
+        font_size (int, optional): Size of the font. Defaults to 60.
+        max_width (int, optional): Wrap lines wider than this many pixels. Defaults to no wrapping.
+        stroke_color (str, optional): Color of the text. Defaults to "black".
+        background_color (str, optional): Background color. Defaults to "white". Use None for transparent.
+        padding (tuple, optional): Padding (x, y) around the text. If None, uses (20, 20).
+    """
+    if font_path is None:
+        raise ValueError("font_path is required")
+    if padding is None:
+        padding = (20, 20)
+
+    atlas = get_atlas(font_path, font_size)
+    lines = atlas.wrap(sitelen, max_width)
+    width = max([atlas.width(line) for line in lines] + [0])
+    mode = "RGBA" if background_color is None else "RGB"
+    image = Image.new(
+        mode,
+        (int(width) + 2 * padding[0], len(lines) * atlas.line_height + 2 * padding[1]),
+        color=background_color or (0, 0, 0, 0),
+    )
+    fill = ImageColor.getcolor(stroke_color, mode)
+    for i, line in enumerate(lines):
+        atlas.draw(image, (padding[0], padding[1] + i * atlas.line_height), line, fill)
+    return image
+
+
+def render_many(sentences, format: str = None, **kwargs) -> list:
+    """
+    Renders many sentences in one call, sharing the glyph atlas between them.
+
+    Takes the keyword arguments of render_page. Returns images, or encoded bytes
+    if a format such as "png" is given.
+    """
+    images = [render_page(sentence, **kwargs) for sentence in sentences]
+    if format is None:
+        return images
+    encoded = []
+    for image in images:
+        buffer = io.BytesIO()
+        image.save(buffer, format=format)
+        encoded.append(buffer.getvalue())
+    return encoded
@@ -0,0 +1,121 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class SizedLRU:
+    """
+    Thread safe least recently used mapping, bounded by the total size of its values.
+
+    Args:
+        max_bytes (int): Total size of the values to keep.
+        sizeof (callable, optional): Returns the size of a value. Defaults to len.
+    """
+
+    def __init__(self, max_bytes: int, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self.nbytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+class DiskStore:
+    """
+    Files under a directory, keyed by their path relative to it.
+
+    With max_bytes set, the least recently used files are deleted once the files
+    written through the store add up to more than that.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if max_bytes is not None:
+            self._index()
+
+    def _index(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, os.path.relpath(path, self.directory), stat.st_size))
+        for _, key, size in sorted(files):
+            self._sizes[key] = size
+            self.nbytes += size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self.path(key), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        if self.max_bytes is None:
+            return
+
+        with self._lock:
+            self.nbytes += len(data) - self._sizes.pop(key, 0)
+            self._sizes[key] = len(data)
+            while self.nbytes > self.max_bytes and len(self._sizes) > 1:
+                evicted, size = self._sizes.popitem(last=False)
+                self.nbytes -= size
+                try:
+                    os.remove(self.path(evicted))
+                except FileNotFoundError:
+                    pass
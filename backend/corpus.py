@@ -0,0 +1,230 @@
+import asyncio
+import os
+import time
+
+# Seconds between checks for stories written by other processes
+CORPUS_REFRESH = float(os.environ.get("CORPUS_REFRESH", 60))
+# Seconds before an index is rebuilt from scratch; 0 never rebuilds it
+CORPUS_MAX_AGE = float(os.environ.get("CORPUS_MAX_AGE", 0))
+# Stories fetched from MongoDB and indexed per round trip while building
+CORPUS_BATCH_SIZE = 1000
+# Share of an index that may be left over from removed stories before it is rebuilt
+CORPUS_MAX_GARBAGE = 0.25
+
+
+class CorpusIndexes:
+    """
+    An in-memory index over each instance's stories, built by scanning the
+    collection the first time it is used and kept current by the writes this
+    process makes, reported through stories_added and stories_removed.
+
+    Writes made elsewhere (other API processes, the importer) are picked up
+    every refresh seconds: the content_hash of every story is read, once for
+    all the indexes over a collection, and compared with the ones indexed, and
+    only the stories that are new, edited or gone are fetched or removed. With
+    max_age set, or once more than CORPUS_MAX_GARBAGE of an index is garbage,
+    indexes are also rebuilt from scratch in the background while the old index
+    keeps serving, and writes made meanwhile are replayed onto the new one.
+
+    An index is made by make_index(lexicon) and must provide add_many(stories),
+    which also replaces stories it already holds, and remove_many(story_ids),
+    both safe to call from another thread while the index is in use. It may
+    provide garbage, the share of it left over from removed stories.
+
+    Args:
+        make_index (callable): Returns an empty index for an instance's lexicon.
+        projection (dict): Fields the index needs from each story.
+        refresh (float): Seconds between checks for other processes' writes; 0 never checks.
+        max_age (float): Seconds before an index is rebuilt; 0 never rebuilds it.
+    """
+
+    def __init__(
+        self, make_index, projection: dict, refresh: float = CORPUS_REFRESH, max_age: float = CORPUS_MAX_AGE
+    ):
+        self.make_index = make_index
+        self.projection = {**projection, "content_hash": 1}
+        self.refresh = refresh
+        self.max_age = max_age
+        self._indexes = {}
+        self._hashes = {}
+        self._pending = {}
+        self._refreshing = set()
+        self._locks = {}
+        corpora.append(self)
+
+    async def _build(self, instance):
+        name = instance.collection.name
+        index = self.make_index(instance.lexicon)
+        hashes = {}
+        self._pending[name] = pending = []
+        try:
+            cursor = instance.collection.find({}, self.projection).batch_size(CORPUS_BATCH_SIZE)
+            while batch := await cursor.to_list(CORPUS_BATCH_SIZE):
+                await asyncio.to_thread(index.add_many, batch)
+                _record(hashes, "add_many", batch)
+            await self._built(instance, index)
+            for method, args in pending:
+                getattr(index, method)(args)
+                _record(hashes, method, args)
+        finally:
+            del self._pending[name]
+        now = time.monotonic()
+        self._indexes[name] = (index, now, now)
+        self._hashes[name] = hashes
+        print(f"{name}: built {type(index).__name__}")
+        return index
+
+    async def _built(self, instance, index):
+        """Called once an index holds every story scanned, before writes made meanwhile are replayed"""
+
+    async def _refresh(self, instance):
+        """Brings an index up to date with the writes other processes made"""
+        name = instance.collection.name
+        index, built_at, refreshed_at = self._indexes[name]
+        hashes = self._hashes[name]
+        self._refreshing.add(name)
+        try:
+            scan = await _scan_hashes(instance.collection, refreshed_at)
+            current, written = scan.task.result(), scan.written
+            # Stories this process wrote meanwhile are already current
+            changed = [
+                story_id for story_id, digest in current.items()
+                if story_id not in written and hashes.get(story_id, ()) != digest
+            ]
+            removed = [story_id for story_id in hashes if story_id not in current and story_id not in written]
+            for start in range(0, len(changed), CORPUS_BATCH_SIZE):
+                batch = await instance.collection.find(
+                    {"_id": {"$in": changed[start : start + CORPUS_BATCH_SIZE]}}, self.projection
+                ).to_list(None)
+                batch = [story for story in batch if story["_id"] not in written]
+                if batch:
+                    await self._catch_up(name, index, "add_many", batch, written)
+            if removed:
+                await self._catch_up(name, index, "remove_many", removed, written)
+        finally:
+            self._refreshing.discard(name)
+        self._indexes[name] = (index, built_at, time.monotonic())
+        if changed or removed:
+            print(f"{name}: refreshed {type(index).__name__}, {len(changed)} changed, {len(removed)} removed")
+
+    async def _catch_up(self, name: str, index, method: str, args: list, written: set):
+        await asyncio.to_thread(getattr(index, method), args)
+        hashes = self._hashes[name]
+        _record(hashes, method, [arg for arg in args if _story_id(method, arg) not in written])
+        # Written here while the thread ran, so possibly overwritten by the older copy: fetched again next time
+        for story_id in _story_ids(method, args):
+            if story_id in written:
+                hashes.pop(story_id, None)
+        self._changed(name, index)
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Failed to update an index: {task.exception()!r}")
+
+    async def get(self, instance):
+        """Returns the index of an instance, building it first if there is none"""
+        name = instance.collection.name
+        entry = self._indexes.get(name)
+        if entry is None:
+            async with self._locks.setdefault(name, asyncio.Lock()):
+                entry = self._indexes.get(name)
+                if entry is None:
+                    return await self._build(instance)
+        index, built_at, refreshed_at = entry
+        if name not in self._pending and name not in self._refreshing:
+            now = time.monotonic()
+            too_old = self.max_age and now - built_at > self.max_age
+            if too_old or getattr(index, "garbage", 0) > CORPUS_MAX_GARBAGE:
+                asyncio.ensure_future(self._build(instance)).add_done_callback(self._done)
+            elif self.refresh and now - refreshed_at > self.refresh:
+                asyncio.ensure_future(self._refresh(instance)).add_done_callback(self._done)
+        return index
+
+    def _apply(self, name: str, method: str, args: list):
+        if name in self._pending:
+            self._pending[name].append((method, args))
+        entry = self._indexes.get(name)
+        if entry is not None:
+            getattr(entry[0], method)(args)
+            _record(self._hashes[name], method, args)
+            self._changed(name, entry[0])
+
+    def _changed(self, name: str, index):
+        """Called after stories are added to or removed from a built index"""
+
+    def stats(self) -> dict:
+        return {name: len(entry[0]) for name, entry in self._indexes.items()}
+
+
+def _story_id(method: str, arg):
+    return arg["_id"] if method == "add_many" else arg
+
+
+def _story_ids(method: str, args: list) -> list:
+    return [_story_id(method, arg) for arg in args]
+
+
+def _record(hashes: dict, method: str, args: list):
+    # The content_hash of every story an index holds, to spot edits made elsewhere
+    if method == "add_many":
+        hashes.update((story["_id"], story.get("content_hash")) for story in args)
+    else:
+        for story_id in args:
+            hashes.pop(story_id, None)
+
+
+class _HashScan:
+    """
+    The content_hash of every story of a collection, read once for all the
+    indexes over it, with the stories this process has written since the read
+    started, whose hashes the indexes already hold.
+    """
+
+    def __init__(self, collection):
+        self.started = time.monotonic()
+        self.written = set()
+        self.task = asyncio.ensure_future(self._read(collection))
+
+    async def _read(self, collection) -> dict:
+        current = {}
+        cursor = collection.find({}, {"content_hash": 1}).batch_size(CORPUS_BATCH_SIZE * 10)
+        while batch := await cursor.to_list(CORPUS_BATCH_SIZE * 10):
+            current.update((story["_id"], story.get("content_hash")) for story in batch)
+        return current
+
+
+# The latest hash scan of each collection
+_scans = {}
+
+
+async def _scan_hashes(collection, since: float) -> _HashScan:
+    """Returns a finished scan of a collection started after since, starting one if there is none"""
+    scan = _scans.get(collection.name)
+    failed = scan is not None and scan.task.done() and (scan.task.cancelled() or scan.task.exception() is not None)
+    if scan is None or scan.started < since or failed:
+        scan = _scans[collection.name] = _HashScan(collection)
+    await asyncio.shield(scan.task)
+    return scan
+
+
+# Every CorpusIndexes, told about each story written
+corpora = []
+
+
+def _written(collection_name: str, story_ids: list):
+    scan = _scans.get(collection_name)
+    if scan is not None:
+        scan.written.update(story_ids)
+
+
+def stories_added(collection_name: str, stories: list):
+    """Adds new or edited stories to every built index of their collection"""
+    _written(collection_name, _story_ids("add_many", stories))
+    for corpus in corpora:
+        corpus._apply(collection_name, "add_many", stories)
+
+
+def stories_removed(collection_name: str, story_ids: list):
+    _written(collection_name, story_ids)
+    for corpus in corpora:
+        corpus._apply(collection_name, "remove_many", story_ids)
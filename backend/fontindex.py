@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from fontTools.ttLib import TTFont
+
+FONT_INDEX_DIR = os.environ.get("FONT_INDEX_DIR", os.path.expanduser("~/.cache/akesi/fonts"))
+
+BLOCK_SIZE = 256
+BLOCK_BYTES = BLOCK_SIZE // 8
+
+
+class Coverage:
+    """
+    The code points a font has glyphs for, as a bitmap per 256 code point block.
+
+    Only blocks with at least one glyph are stored, so a font covering a corner
+    of a private use plane costs a few dozen bytes rather than a plane's worth.
+    """
+
+    def __init__(self, blocks: dict):
+        self.blocks = blocks
+
+    @classmethod
+    def from_code_points(cls, code_points) -> "Coverage":
+        blocks = {}
+        for code_point in code_points:
+            block = blocks.setdefault(code_point // BLOCK_SIZE, bytearray(BLOCK_BYTES))
+            offset = code_point % BLOCK_SIZE
+            block[offset // 8] |= 1 << (offset % 8)
+        return cls({index: bytes(block) for index, block in blocks.items()})
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Coverage":
+        blocks = {}
+        step = 4 + BLOCK_BYTES
+        if len(data) % step:
+            raise ValueError(f"Coverage of {len(data)} bytes is not a whole number of blocks")
+        for start in range(0, len(data), step):
+            (index,) = struct.unpack_from("<I", data, start)
+            blocks[index] = data[start + 4 : start + step]
+        return cls(blocks)
+
+    def to_bytes(self) -> bytes:
+        return b"".join(
+            struct.pack("<I", index) + block for index, block in sorted(self.blocks.items())
+        )
+
+    def __contains__(self, code_point: int) -> bool:
+        block = self.blocks.get(code_point // BLOCK_SIZE)
+        if block is None:
+            return False
+        offset = code_point % BLOCK_SIZE
+        return bool(block[offset // 8] & (1 << (offset % 8)))
+
+    def __len__(self) -> int:
+        return sum(bin(byte).count("1") for block in self.blocks.values() for byte in block)
+
+
+def _write(path: str, data: bytes):
+    # Written aside and moved into place, so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class FontIndex:
+    """
+    Coverage of a chain of fonts, in order of preference.
+
+    Each font is parsed with fontTools only the first time it is seen. Its
+    coverage is then cached in FONT_INDEX_DIR, named by the hash of the font file,
+    with a manifest of paths and mtimes so unchanged fonts are not even rehashed.
+    """
+
+    def __init__(self, font_paths: list, directory: str = FONT_INDEX_DIR):
+        self.font_paths = list(font_paths)
+        self.directory = directory
+        self._coverage = {}
+        self._lock = threading.Lock()
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self._manifest_path(), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def coverage(self, font_path: str) -> Coverage:
+        """Returns the coverage of a font, from memory, the disk cache, or the font itself"""
+        coverage = self._coverage.get(font_path)
+        if coverage is not None:
+            return coverage
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            stat = os.stat(font_path)
+            manifest = self._load_manifest()
+            entry = manifest.get(os.path.abspath(font_path))
+            if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                digest = entry["sha256"]
+            else:
+                with open(font_path, "rb") as file:
+                    digest = hashlib.sha256(file.read()).hexdigest()
+
+            cached_path = os.path.join(self.directory, f"{digest}.cov")
+            try:
+                with open(cached_path, "rb") as file:
+                    coverage = Coverage.from_bytes(file.read())
+            except (FileNotFoundError, ValueError):
+                font = TTFont(font_path, lazy=True)
+                coverage = Coverage.from_code_points(font.getBestCmap() or {})
+                font.close()
+                _write(cached_path, coverage.to_bytes())
+
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": digest}
+            if manifest.get(os.path.abspath(font_path)) != entry:
+                # Read again just before writing, to keep entries other processes added meanwhile
+                manifest = self._load_manifest()
+                manifest[os.path.abspath(font_path)] = entry
+                _write(self._manifest_path(), json.dumps(manifest).encode("utf-8"))
+            self._coverage[font_path] = coverage
+        return coverage
+
+    def font_for(self, char: str) -> str | None:
+        """Returns the first font in the chain with a glyph for char, or None"""
+        code_point = ord(char)
+        for font_path in self.font_paths:
+            if code_point in self.coverage(font_path):
+                return font_path
+        return None
+
+    def runs(self, text: str) -> list:
+        """
+        Splits text into runs that can each be drawn with a single font.
+
+        Returns:
+            list: (font path, text) pairs in order. The font path is None for
+            characters that no font in the chain covers.
+        """
+        runs = []
+        chosen = {}
+        for char in text:
+            if char not in chosen:
+                chosen[char] = self.font_for(char)
+            font_path = chosen[char]
+            if runs and runs[-1][0] == font_path:
+                runs[-1][1].append(char)
+            else:
+                runs.append((font_path, [char]))
+        return [(font_path, "".join(chars)) for font_path, chars in runs]
+
+    def missing(self, text: str) -> set:
+        """Returns the characters in text that no font in the chain covers"""
+        return {char for char in set(text) if self.font_for(char) is None}
+
+
+_indexes = {}
+
+
+def get_index(font_paths) -> FontIndex:
+    """Returns a shared FontIndex for a chain of fonts"""
+    font_paths = tuple(path for path in font_paths if path is not None)
+    index = _indexes.get(font_paths)
+    if index is None:
+        index = _indexes[font_paths] = FontIndex(font_paths)
+    return index
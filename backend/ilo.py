@@ -1,12 +1,18 @@
 import re
 import os
+import itertools
+import hashlib
+import functools
+import io
+import bisect
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
 import uuid
-import markdown
+from fontindex import get_index
 
-# from fontTools.ttLib import TTFont
-
-# TODO ligatures
+# Bump whenever tokenizer output changes so cached and stored tokens are redone
+TOKENIZER_VERSION = "4"
 
 UNORTHODOXIES = {"ali": "ale"}
 
@@ -282,7 +288,85 @@ ASCII_TO_DEFINITION = {
     "wile": "must, need, require; want",
 }
 
-tokimap = ASCII_TO_DEFINITION
+CARTOUCHE_GLYPHS = {"[": "\U000F1990", "]": "\U000F1991"}
+# Ligatures: toki+pona is joined with a zero width joiner, toki^pona is stacked
+# and toki*pona is scaled, following the UCSUR joiners
+JOINERS = {"+": "\u200d", "^": "\U000F1995", "*": "\U000F1996"}
+WORD_RE = re.compile(r"^[aeioujklmnpstw]+$")
+
+
+class Lexicon:
+    """
+    Frozen index of the toki pona vocabulary for constant time lookups.
+
+    Merges ASCII_TO_SITELEN, ASCII_TO_DEFINITION and UNORTHODOXIES, plus any extra
+    words for an instance, so that validation, canonicalisation, the UCSUR glyph
+    and the definition all agree on what a word is.
+
+    Args:
+        extra_words (dict, optional): Extra words mapped to their definition, or None.
+    """
+
+    def __init__(self, extra_words: dict = None):
+        words = {}
+        for word, glyph in ASCII_TO_SITELEN.items():
+            if word not in CARTOUCHE_GLYPHS:
+                words[word] = (glyph, None)
+        for word, definition in ASCII_TO_DEFINITION.items():
+            words[word] = (words.get(word, (None, None))[0], definition)
+        self.extra_words = dict(extra_words or {})
+        for word, definition in self.extra_words.items():
+            if WORD_RE.match(word) is None:
+                raise ValueError(f"Not a toki pona word: {word}")
+            words[word] = (words.get(word, (None, None))[0], definition)
+
+        self.words = frozenset(words)
+        self.glyphs = {word: glyph for word, (glyph, _) in words.items() if glyph}
+        self._definitions = {word: d for word, (_, d) in words.items() if d is not None}
+        self._canonical = dict(UNORTHODOXIES)
+        self._words_by_glyph = {}
+        for word, glyph in ASCII_TO_SITELEN.items():
+            self._words_by_glyph.setdefault(glyph, self._canonical.get(word, word))
+        # str.translate table for UCSUR to ascii
+        self.ascii_table = {ord(glyph): f"{word} " for glyph, word in self._words_by_glyph.items()}
+        self.ascii_table.update({ord(joiner): ascii for ascii, joiner in JOINERS.items()})
+
+        if self.extra_words:
+            fingerprint = hashlib.sha1(
+                repr(sorted(self.extra_words.items())).encode("utf-8")
+            ).hexdigest()[:8]
+            self.version = f"{TOKENIZER_VERSION}.{fingerprint}"
+        else:
+            self.version = TOKENIZER_VERSION
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.words
+
+    def with_words(self, extra_words: dict) -> "Lexicon":
+        """Returns a new lexicon with more words added"""
+        return Lexicon({**self.extra_words, **extra_words})
+
+    def canonical(self, word: str) -> str:
+        """Returns the standard spelling of a word, e.g. ale for ali"""
+        return self._canonical.get(word, word)
+
+    def glyph(self, word: str) -> str | None:
+        """Returns the UCSUR glyph for a word, or None"""
+        return self.glyphs.get(word)
+
+    def word_for_glyph(self, glyph: str) -> str | None:
+        """Returns the canonical word for a UCSUR glyph, or None"""
+        return self._words_by_glyph.get(glyph)
+
+    def definition(self, word: str) -> str | None:
+        return self._definitions.get(word)
+
+    def is_legal(self, string: str) -> bool:
+        """True if the string is one or more known words separated by single spaces"""
+        return all(word in self.words for word in string.strip(" ").split(" "))
+
+
+LEXICON = Lexicon()
 
 
 def is_ucsur(string: str) -> bool:
@@ -290,37 +374,85 @@ def is_ucsur(string: str) -> bool:
     return any(0xF1900 <= ord(char) <= 0xF19FF for char in string)
 
 
-def ascii_to_ucsur(string: str) -> str:
-    """Converts a string of ascii toki ponawords to a string of UCSUR encoded sitelen pona glyphs"""
-    result = ""
-    for word in string.split():
-        word_no_punctuation = word.strip(".,!?").lower()
-        result += word.replace(
-            word_no_punctuation,
-            ASCII_TO_SITELEN.get(word_no_punctuation, word_no_punctuation),
-        )
-    return result
+ASCII_WORD_RE = re.compile(r"(?<!\w)[a-z]+(?:[+^*][a-z]+)*(?!\w)")
+TOKI_NAME_RE = re.compile(r"\[[^\]|]*\|([^\]]*)\]")
+LIGATURE_RE = re.compile(r"([+^*])")
+CARTOUCHE_RE = re.compile("\U000F1990([^\U000F1990\U000F1991]*)\U000F1991")
+PUNCTUATION_SPACE_RE = re.compile(r" ([.,!?+^*])")
+
+
+def _word_to_ucsur(match, lexicon: Lexicon) -> str:
+    word = match.group()
+    glyph = lexicon.glyph(word)
+    if glyph is not None:
+        return glyph
+    parts = LIGATURE_RE.split(word)
+    glyphs = [JOINERS.get(part) or lexicon.glyph(part) for part in parts]
+    if len(parts) > 1 and all(glyphs):
+        return "".join(glyphs)
+    return word
 
 
-def ucsur_to_ascii(string: str) -> str:
+def _cartouche_to_ucsur(match, lexicon: Lexicon) -> str:
+    # A [name|toki name] is written as a cartouche of its toki name
+    glyphs = [lexicon.glyph(word) for word in match.group(1).split()]
+    if glyphs and all(glyphs):
+        return CARTOUCHE_GLYPHS["["] + "".join(glyphs) + CARTOUCHE_GLYPHS["]"]
+    return match.group()
+
+
+def ascii_to_ucsur(string: str, lexicon: Lexicon = LEXICON) -> str:
+    """Converts a string of ascii toki pona words to a string of UCSUR encoded sitelen pona glyphs"""
+    if "[" in string:
+        string = TOKI_NAME_RE.sub(lambda match: _cartouche_to_ucsur(match, lexicon), string)
+    # Bare words are looked up directly; anything with punctuation or joiners
+    # attached goes through the regex
+    glyphs = lexicon.glyphs
+    return "".join(
+        [
+            glyphs.get(word)
+            or ASCII_WORD_RE.sub(lambda match: _word_to_ucsur(match, lexicon), word)
+            for word in string.split()
+        ]
+    )
+
+
+def _cartouche_to_ascii(match, lexicon: Lexicon) -> str:
+    words = match.group(1).translate(lexicon.ascii_table).split()
+    name = "".join(word[0] for word in words).capitalize()
+    return f"[{name}|{' '.join(words)}] "
+
+
+def ucsur_to_ascii(string: str, lexicon: Lexicon = LEXICON) -> str:
     """Converts a string of UCSUR encoded sitelen pona glyphs to a string of ascii toki pona words"""
-    result = ""
-    for char in string:
-        if char in ASCII_TO_SITELEN.values():
-            result += (
-                list(ASCII_TO_SITELEN.keys())[
-                    list(ASCII_TO_SITELEN.values()).index(char)
-                ]
-                + " "
-            )
-        else:
-            result += char
-    # remove spaces before punctuation
-    result = re.sub(r" (\.|,|!|\?)", r"\1", result)
+    # a cartouche reads as the name spelled by the first letter of each word
+    result = CARTOUCHE_RE.sub(lambda match: _cartouche_to_ascii(match, lexicon), string)
+    result = result.translate(lexicon.ascii_table)
+    # remove spaces before punctuation and joiners
+    result = PUNCTUATION_SPACE_RE.sub(r"\1", result)
     # remove trailing space
     return result.strip()
 
 
+def tokens_to_ucsur(tokens: list, lexicon: Lexicon = LEXICON) -> list:
+    """
+    Converts a whole token stream to sitelen pona.
+
+    Returns a copy of tokens where toki pona text is UCSUR encoded, and names with a
+    toki name gain a "ucsur" cartouche. Other tokens are left as they are.
+    """
+    converted = []
+    for tok in tokens:
+        if tok["type"] == "tokipona":
+            tok = {"type": "tokipona", "content": ascii_to_ucsur(tok["content"], lexicon)}
+        elif tok["type"] == "name" and tok["content"].get("toki_name"):
+            name = tok["content"]
+            cartouche = ascii_to_ucsur(f"[{name['name']}|{name['toki_name']}]", lexicon)
+            tok = {"type": "name", "content": {**name, "ucsur": cartouche}}
+        converted.append(tok)
+    return converted
+
+
 def font_has_glyph(font_path, code_point):
     """
     Check if a font has a glyph for a specific Unicode code point.
@@ -333,61 +465,44 @@ def font_has_glyph(font_path, code_point):
         bool: True if the font has a glyph for the code point, False otherwise.
     """
     try:
-        font = TTFont(font_path)
-        for table in font["cmap"].tables:
-            if code_point in table.cmap.keys():
-                return True
-        return False
+        return code_point in get_index([font_path]).coverage(font_path)
     except Exception as e:
         print(f"Error checking font: {e}")
         return False
 
 
-def sitelen_to_image(
+ASCII_FONT = os.environ.get("ASCII_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+
+@functools.lru_cache(maxsize=64)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    """Loads a font once per (path, size) for the whole process"""
+    return ImageFont.truetype(font_path, font_size)
+
+
+def render_sitelen(
     sitelen: str,
     ascii: bool = False,
     font_path: str = os.environ.get("SITELEN_FONT", None),
-    output_file: str = None,
     stroke_color: str = "black",
     background_color: str = "white",
     font_size: int = 60,
     padding: tuple = None,
     ascii_font_size: int = 16,
-    open_file: bool = False,
-) -> str:
+) -> Image.Image:
     """
-    Convert sitelen pona text to an image.
-
-    Args:
-        sitelen (str): The sitelen pona text to render.
-        ascii (bool, optional): Whether to include ASCII text below the sitelen pona. Defaults to False.
-        font_path (str, optional): Path to the sitelen pona font file. Required if not set as default.
-        output_file (str, optional): Path to save the output image. If None, saves to a temporary file.
-        stroke_color (str, optional): Color of the text. Defaults to "black".
-        background_color (str, optional): Background color of the image. Defaults to "white". Use None for transparent.
-        font_size (int, optional): Size of the sitelen pona font. Defaults to 60.
-        padding (tuple, optional): Padding (x, y) around the text. If None, uses (20, 20).
-        ascii_font_size (int, optional): Size of the ASCII font. Defaults to 24.
-        open_file (bool, optional): Whether to open the image file after saving. Defaults to False.
-    Returns:
-        str: Path to the saved image file.
+    Draw sitelen pona text onto a new image. Takes the same arguments as sitelen_to_image.
 
     Raises:
+        ValueError: If no font path is given.
         IOError: If the font file cannot be loaded.
     """
     if font_path is None:
         raise ValueError("font_path is required")
 
-    if output_file is None:
-        output_file = os.path.join("/tmp", f"{uuid.uuid4()}.png")
-
     if padding is None:
         padding = (20, 20)
-    try:
-        font = ImageFont.truetype(font_path, font_size)
-    except IOError as e:
-        print(f"Could not load font: {font_path}, {e}")
-        return
+    font = load_font(font_path, font_size)
 
     # Calculate text dimensions
     temp_image = Image.new("RGBA", (1, 1))
@@ -414,9 +529,7 @@ def sitelen_to_image(
 
     if ascii:
         ascii_text = ucsur_to_ascii(sitelen)
-        ascii_font = ImageFont.truetype(
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", ascii_font_size
-        )
+        ascii_font = load_font(ASCII_FONT, ascii_font_size)
         ascii_bbox = draw.textbbox((0, 0), ascii_text, font=ascii_font)
         ascii_width = ascii_bbox[2] - ascii_bbox[0]
         ascii_x = (image_width - ascii_width) // 2
@@ -427,191 +540,829 @@ def sitelen_to_image(
             font=ascii_font,
         )
 
+    return image
+
+
+def sitelen_to_bytes(sitelen: str, format: str = "png", **kwargs) -> bytes:
+    """Renders sitelen pona text to encoded image bytes. See render_sitelen for the arguments."""
+    buffer = io.BytesIO()
+    render_sitelen(sitelen, **kwargs).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def sitelen_to_image(
+    sitelen: str,
+    ascii: bool = False,
+    font_path: str = os.environ.get("SITELEN_FONT", None),
+    output_file: str = None,
+    stroke_color: str = "black",
+    background_color: str = "white",
+    font_size: int = 60,
+    padding: tuple = None,
+    ascii_font_size: int = 16,
+    open_file: bool = False,
+) -> str:
+    """
+    Convert sitelen pona text to an image.
+
+    Args:
+        sitelen (str): The sitelen pona text to render.
+        ascii (bool, optional): Whether to include ASCII text below the sitelen pona. Defaults to False.
+        font_path (str, optional): Path to the sitelen pona font file. Required if not set as default.
+        output_file (str, optional): Path to save the output image. If None, saves to a temporary file.
+        stroke_color (str, optional): Color of the text. Defaults to "black".
+        background_color (str, optional): Background color of the image. Defaults to "white". Use None for transparent.
+        font_size (int, optional): Size of the sitelen pona font. Defaults to 60.
+        padding (tuple, optional): Padding (x, y) around the text. If None, uses (20, 20).
+        ascii_font_size (int, optional): Size of the ASCII font. Defaults to 24.
+        open_file (bool, optional): Whether to open the image file after saving. Defaults to False.
+    Returns:
+        str: Path to the saved image file.
+
+    Raises:
+        IOError: If the font file cannot be loaded.
+    """
+    if font_path is None:
+        raise ValueError("font_path is required")
+
+    if output_file is None:
+        output_file = os.path.join("/tmp", f"{uuid.uuid4()}.png")
+
+    try:
+        image = render_sitelen(
+            sitelen,
+            ascii=ascii,
+            font_path=font_path,
+            stroke_color=stroke_color,
+            background_color=background_color,
+            font_size=font_size,
+            padding=padding,
+            ascii_font_size=ascii_font_size,
+        )
+    except IOError as e:
+        print(f"Could not load font: {font_path}, {e}")
+        return
+
     image.save(output_file)
     if open_file:
         os.system(f"xdg-open {output_file}")
     return output_file
 
 
-def is_legal_toki_pona(string: str) -> bool:
-    cleaned = "".join([x for x in string if x in " aeioujklmnpstw"])
-
-    a = re.match(r"^[a-z ]+$", string) is not None
-    b = re.match(r"^[ aeioujklmnpstw]+$", string) is not None
-    c = len([x for x in cleaned.strip().split(" ") if x not in tokimap]) == 0
-    return a and b and c
+def is_legal_toki_pona(string: str, lexicon: Lexicon = LEXICON) -> bool:
+    return lexicon.is_legal(string)
 
 
-def split_fancy_names(string: str):
+def split_fancy_names(string: str, lexicon: Lexicon = LEXICON):
     if "|" in string:
         tokens = string.split("|")
     else:
         return {"name": string}
     if len(tokens) != 2:
         return {"name": string}
-    if is_legal_toki_pona(tokens[1]):
+    if lexicon.is_legal(tokens[1]):
         return {"name": tokens[0].strip(), "toki_name": tokens[1].strip()}
     else:
         return {"name": tokens[0].strip()}
 
 
-def handle_markdown(content: str):
-    content = content.replace("\n\n", "\nPARAGRAPH_BREAK")
-    markdown_text = markdown.markdown(content, extensions=['tables']).replace("<p>", "").replace("</p>", "")
-    markdown_text = re.sub(r'(<br */?>)', r'', markdown_text)
-    if "<" not in markdown_text:
-        return _preprocess(content)
-    markdown_text = re.sub(r'(</h[1-3]>)\n', r'\1', markdown_text)
+HEADING_RE = re.compile(r"(#{1,6})[ \t]+(.*?)[ \t#]*$")
+SETEXT_RE = re.compile(r"(=+|-+)[ \t]*$")
+RULE_RE = re.compile(r" {0,3}([-*_])(?: {0,2}\1){2,}[ \t]*$")
+QUOTE_RE = re.compile(r" {0,3}> ?")
+CODE_INDENT_RE = re.compile(r"(?: {4}|\t)(.*)$")
+LIST_ITEM_RE = re.compile(r" {0,3}(?:[*+-]|(\d+)\.)[ \t]+(.*)$")
+TABLE_RULE_RE = re.compile(r"\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+TABLE_CELL_RE = re.compile(r"\[[^\]]*\]|\{[^}]*\}|(\|)")
+ALIGNMENTS = {(True, False): "left", (False, True): "right", (True, True): "center"}
+# Names and escapes are passed over whole so their contents are never markup.
+# Bracketed spans stop at the next opening bracket too, so a run of unclosed
+# brackets costs one pass rather than a scan to the end of the text for each.
+INLINE_RE = re.compile(
+    r"\[[^\[\]]*\](?!\()|\{[^{}]*\}"
+    r'|!\[(?P<alt>[^\[\]]*)\]\((?P<src>[^)\s]*)(?:\s+"(?P<src_title>[^"]*)")?\)'
+    r'|\[(?P<text>[^\[\]]*)\]\((?P<href>[^)\s]*)(?:\s+"(?P<href_title>[^"]*)")?\)'
+    r"|(?P<code>`+)"
+    r"|(?P<delimiter>\*+|_+)"
+)
+BACKTICKS_RE = re.compile(r"`+")
+EMPHASIS = {1: ["em"], 2: ["strong"], 3: ["strong", "em"]}
 
-    markdown_tokens = markdown_text.split("<")
-    toks = []
-    for t in markdown_tokens:
-        if len(t) == 0:
-            continue
-        try:
-            m, c = t.split(">")
-        except:
-            m = ""
-            c = t
-        if len(m) > 0:
-            toks.append({"type": "markdown", "content": m})
-        toks+= _preprocess(c)
-
-    return toks
-
-    
-def preprocess(content: str):
-    return handle_markdown(content)
-    
-def _preprocess(content: str):
-    content = content.replace("PARAGRAPH_BREAK", "\n")
-    tokens = []
-    token_type = "tokipona"
-    output = ""
-
-    i = 0
-    while i < len(content):
-        if i >= len(content):
-            break
-        c = content[i]
-        rest = content[i:]
-        if c in "[{":
-            token_type = "tokipona"
-            tokens.append((token_type, output))
-            if c == "[":
-                if "]" in rest:
-                    output = rest[1 : rest.index("]")]
-                    i += len(output) + 2
-                    names = split_fancy_names(rest[1 : rest.index("]")])
-                    tokens.append(("name", names))
-                else:
-                    token_type = "error"
-                    tokens.append((token_type, rest))
-                    break
-            elif c == "{":
-                if "}" in rest:
-                    output = rest[1 : rest.index("}")]
-                    tokens.append(("escaped", output))
-                    i += len(output) + 2
-                else:
-                    token_type = "error"
-                    tokens.append((token_type, rest))
+
+def _split_row(line: str) -> list:
+    """Splits a table row on the pipes that aren't inside a name or escape"""
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    cells = []
+    start = 0
+    for match in TABLE_CELL_RE.finditer(line):
+        if match.group(1) is not None:
+            cells.append(line[start : match.start()].strip())
+            start = match.end()
+    cells.append(line[start:].strip())
+    return cells
+
+
+class _Delimiter:
+    """A run of * or _ that may open or close emphasis, with the tags it got"""
+
+    __slots__ = ("char", "count", "can_open", "can_close", "opens", "closes")
+
+    def __init__(self, run: str, before: str, after: str):
+        self.char = run[0]
+        self.count = len(run)
+        self.can_open = not after.isspace()
+        self.can_close = not before.isspace()
+        if self.char == "_":
+            # No emphasis inside words with underscores
+            self.can_open = self.can_open and not before.isalnum()
+            self.can_close = self.can_close and not after.isalnum()
+        self.opens = []
+        self.closes = []
+
+
+def _match_emphasis(delimiters: list):
+    """
+    Pairs up delimiter runs into emphasis in one pass with a stack of openers.
+
+    A closer takes the nearest opener of its character, and the openers it
+    skips can no longer be closed. bottom remembers where a closer last found
+    nothing, so later closers never search those openers again.
+    """
+    stack = []
+    bottom = {"*": 0, "_": 0}
+    for run in delimiters:
+        if run.can_close:
+            while run.count:
+                j = len(stack) - 1
+                while j >= bottom[run.char] and stack[j].char != run.char:
+                    j -= 1
+                if j < bottom[run.char]:
+                    bottom[run.char] = len(stack)
                     break
-            output, token_type = "", "tokipona"
-            continue
-            # output += c
-            # i += 0
-            # continue
-
-        # use regex. get the next word
-        next_word = re.match(r"[\w]+", rest)
-        if next_word is not None:
-            w = next_word[0]
-            if w in UNORTHODOXIES:
-                w = UNORTHODOXIES[w]
-
-            # check if w has a capital letter in it
-            i += len(w)
-            if re.match(r".*[A-Z].*", w):
-                tokens.append((token_type, output))
-                output, token_type = "", "tokipona"
-                tokens.append(("name", {"name": w}))
+                opener = stack[j]
+                use = 3 if min(opener.count, run.count) >= 3 else 2 if min(opener.count, run.count) >= 2 else 1
+                tags = EMPHASIS[use]
+                opener.opens[0:0] = tags
+                run.closes += [f"/{tag}" for tag in reversed(tags)]
+                opener.count -= use
+                run.count -= use
+                del stack[j + (opener.count > 0) :]
+                for char in bottom:
+                    bottom[char] = min(bottom[char], len(stack))
+        if run.count and run.can_open:
+            stack.append(run)
+
+
+class _MarkdownTokenizer:
+    """
+    Tokenizes markdown in one pass over its lines, emitting a markdown token for
+    each tag and toki pona tokens for the text in between.
+
+    Handles headings, rules, blockquotes, code, emphasis, links, images, lists
+    and tables. The tags and the whitespace between them are the ones the
+    markdown package renders to HTML.
+    """
+
+    def __init__(self, content: str, lexicon: Lexicon = LEXICON):
+        self.lines = content.split("\n")
+        self.lexicon = lexicon
+        self.toks = []
+        self.text = []
+
+    def emit_text(self, text: str):
+        self.text.append(text)
+
+    def emit_tag(self, tag: str):
+        if self.text:
+            self.toks += _preprocess("".join(self.text), self.lexicon)
+            self.text = []
+        self.toks.append({"type": "markdown", "content": tag})
+
+    def tokenize(self) -> list:
+        self.blocks(self.lines)
+        if self.text:
+            self.toks += _preprocess("".join(self.text), self.lexicon)
+        return self.toks
+
+    def heading(self, level: int, text: str, newline: str):
+        self.emit_tag(f"h{level}")
+        self.inline(text)
+        self.emit_tag(f"/h{level}")
+        if level > 3:
+            self.emit_text(newline)
+
+    def blocks(self, lines: list):
+        block_start = True
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            newline = "\n" if i < len(lines) - 1 else ""
+            heading = HEADING_RE.match(line)
+            if line.strip() == "":
+                self.emit_text(line + newline)
+                block_start = True
+                i += 1
+            elif heading is not None:
+                self.heading(len(heading[1]), heading[2], newline)
+                block_start = True
+                i += 1
+            elif RULE_RE.match(line) is not None:
+                self.emit_tag("hr /")
+                self.emit_text(newline)
+                block_start = True
+                i += 1
+            elif QUOTE_RE.match(line) is not None:
+                i = self.quote_block(lines, i)
+                block_start = True
+            elif block_start and CODE_INDENT_RE.match(line) is not None:
+                i = self.code_block(lines, i)
+            elif block_start and LIST_ITEM_RE.match(line) is not None:
+                i = self.list_block(lines, i)
+            elif (
+                block_start
+                and "|" in line
+                and i + 1 < len(lines)
+                and TABLE_RULE_RE.match(lines[i + 1]) is not None
+            ):
+                i = self.table_block(lines, i)
+            elif block_start and i + 1 < len(lines) and SETEXT_RE.match(lines[i + 1]) is not None:
+                level = 1 if lines[i + 1][0] == "=" else 2
+                self.heading(level, line.strip(), "\n" if i + 1 < len(lines) - 1 else "")
+                i += 2
             else:
-                if not is_legal_toki_pona(w):
-                    tokens.append((token_type, output))
-                    tokens.append(("illegal", w))
-                    token_type = "tokipona"
-                    output = ""
-                else:
-                    output += w
-        else:
-            output += c
+                i = self.paragraph(lines, i)
+                block_start = False
+
+    def interrupts(self, line: str) -> bool:
+        """True if a line starts a block even in the middle of a paragraph"""
+        return (
+            line.strip() == ""
+            or HEADING_RE.match(line) is not None
+            or RULE_RE.match(line) is not None
+            or QUOTE_RE.match(line) is not None
+        )
+
+    def paragraph(self, lines: list, i: int) -> int:
+        end = i + 1
+        while end < len(lines) and not self.interrupts(lines[end]):
+            end += 1
+        self.inline("\n".join(lines[i:end]))
+        self.emit_text("\n" if end < len(lines) else "")
+        return end
+
+    def quote_block(self, lines: list, i: int) -> int:
+        inner = []
+        while i < len(lines) and lines[i].strip() != "":
+            quote = QUOTE_RE.match(lines[i])
+            if quote is not None:
+                inner.append(lines[i][quote.end() :])
+            elif HEADING_RE.match(lines[i]) is None and RULE_RE.match(lines[i]) is None:
+                # Lazy continuation of the quoted paragraph
+                inner.append(lines[i])
+            else:
+                break
+            i += 1
+
+        self.emit_tag("blockquote")
+        self.emit_text("\n")
+        self.blocks(inner)
+        self.emit_text("\n")
+        self.emit_tag("/blockquote")
+        self.emit_text("\n" if i < len(lines) else "")
+        return i
+
+    def code_block(self, lines: list, i: int) -> int:
+        code = []
+        while i < len(lines):
+            indented = CODE_INDENT_RE.match(lines[i])
+            if indented is not None:
+                code.append(indented[1])
+            elif lines[i].strip() == "":
+                code.append("")
+            else:
+                break
             i += 1
+        # Blank lines after the block aren't part of it
+        while code and code[-1] == "":
+            code.pop()
+            i -= 1
+
+        self.emit_tag("pre")
+        self.emit_tag("code")
+        self.emit_text("\n".join(code) + "\n")
+        self.emit_tag("/code")
+        self.emit_tag("/pre")
+        self.emit_text("\n" if i < len(lines) else "")
+        return i
+
+    def block_end(self, lines: list, i: int):
+        # A block straight after a list or table is set on its own line
+        if i < len(lines) and lines[i].strip() != "":
+            self.emit_text("\n")
+
+    def list_block(self, lines: list, i: int) -> int:
+        kind = "ul" if LIST_ITEM_RE.match(lines[i])[1] is None else "ol"
+        items = []
+        while i < len(lines):
+            item = LIST_ITEM_RE.match(lines[i])
+            if item is not None and RULE_RE.match(lines[i]) is None:
+                items.append(item[2])
+            elif not self.interrupts(lines[i]):
+                # Lazy continuation of the previous item
+                items[-1] += "\n" + lines[i].strip()
+            else:
+                break
+            i += 1
+
+        self.emit_tag(kind)
+        for item in items:
+            self.emit_text("\n")
+            self.emit_tag("li")
+            self.inline(item)
+            self.emit_tag("/li")
+        self.emit_text("\n")
+        self.emit_tag(f"/{kind}")
+        self.block_end(lines, i)
+        return i
+
+    def table_block(self, lines: list, i: int) -> int:
+        header = _split_row(lines[i])
+        alignments = []
+        for rule in _split_row(lines[i + 1]):
+            alignment = ALIGNMENTS.get((rule.startswith(":"), rule.endswith(":")))
+            alignments.append(f' style="text-align: {alignment};"' if alignment else "")
+        alignments = (alignments + [""] * len(header))[: len(header)]
+        i += 2
+        rows = []
+        while i < len(lines) and "|" in lines[i] and lines[i].strip() != "":
+            rows.append(_split_row(lines[i]))
+            i += 1
+        if not rows:
+            rows.append([])
+
+        self.emit_tag("table")
+        self.emit_text("\n")
+        self.emit_tag("thead")
+        self.emit_text("\n")
+        self.table_row("th", header, alignments)
+        self.emit_tag("/thead")
+        self.emit_text("\n")
+        self.emit_tag("tbody")
+        self.emit_text("\n")
+        for row in rows:
+            row = (row + [""] * len(header))[: len(header)]
+            self.table_row("td", row, alignments)
+        self.emit_tag("/tbody")
+        self.emit_text("\n")
+        self.emit_tag("/table")
+        self.block_end(lines, i)
+        return i
+
+    def table_row(self, cell_tag: str, cells: list, alignments: list):
+        self.emit_tag("tr")
+        self.emit_text("\n")
+        for cell, alignment in zip(cells, alignments):
+            self.emit_tag(f"{cell_tag}{alignment}")
+            self.inline(cell)
+            self.emit_tag(f"/{cell_tag}")
+            self.emit_text("\n")
+        self.emit_tag("/tr")
+        self.emit_text("\n")
+
+    def inline(self, text: str):
+        for item in self.inline_items(text):
+            if isinstance(item, str):
+                self.emit_text(item)
+            elif isinstance(item, tuple):
+                self.emit_tag(item[1])
+            else:
+                for tag in item.closes:
+                    self.emit_tag(tag)
+                self.emit_text(item.char * item.count)
+                for tag in item.opens:
+                    self.emit_tag(tag)
+
+    def inline_items(self, text: str) -> list:
+        """
+        Splits text into strings, ("tag", tag) tuples and the delimiter runs
+        between them, in one scan, with the emphasis the runs make.
+        """
+        items = []
+        delimiters = []
+        backticks = None
+        position = 0
+        match = INLINE_RE.search(text)
+        while match is not None:
+            end = match.end()
+            if match["delimiter"] is not None:
+                before = text[match.start() - 1] if match.start() else " "
+                after = text[end] if end < len(text) else " "
+                run = _Delimiter(match["delimiter"], before, after)
+                items.append(text[position : match.start()])
+                items.append(run)
+                delimiters.append(run)
+                position = end
+            elif match["code"] is not None:
+                if backticks is None:
+                    backticks = {}
+                    for run in BACKTICKS_RE.finditer(text):
+                        backticks.setdefault(len(run[0]), []).append(run.start())
+                starts = backticks[len(match["code"])]
+                # The next run of as many backticks closes the span
+                closing = bisect.bisect_right(starts, match.start())
+                if closing < len(starts):
+                    items.append(text[position : match.start()])
+                    items.append(("tag", "code"))
+                    items.append(text[end : starts[closing]].strip())
+                    items.append(("tag", "/code"))
+                    end = position = starts[closing] + len(match["code"])
+            elif match["src"] is not None:
+                items.append(text[position : match.start()])
+                title = match["src_title"]
+                title = f' title="{title}"' if title is not None else ""
+                items.append(("tag", f'img alt="{match["alt"]}" src="{match["src"]}"{title} /'))
+                position = end
+            elif match["href"] is not None:
+                items.append(text[position : match.start()])
+                title = match["href_title"]
+                title = f' title="{title}"' if title is not None else ""
+                items.append(("tag", f'a href="{match["href"]}"{title}'))
+                items += self.inline_items(match["text"])
+                items.append(("tag", "/a"))
+                position = end
+            match = INLINE_RE.search(text, end)
+        items.append(text[position:])
+        _match_emphasis(delimiters)
+        return items
+
+
+def handle_markdown(content: str, lexicon: Lexicon = LEXICON):
+    return _MarkdownTokenizer(content, lexicon).tokenize()
+
+
+def preprocess(content: str, lexicon: Lexicon = LEXICON):
+    return handle_markdown(content, lexicon)
+
+
+# Batches smaller than this are tokenized in process; the pool isn't worth it
+MIN_POOL_BATCH = int(os.environ.get("MIN_POOL_BATCH", 64))
+
+# Shared process pools by worker count, kept open since another thread may be mapping on one
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Returns the shared process pool of workers processes, starting it on first use"""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+        return pool
+
+
+def preprocess_many(
+    contents, workers: int = None, chunksize: int = None, lexicon: Lexicon = LEXICON
+) -> list:
+    """
+    Preprocess many documents, in parallel where it pays off.
+
+    Args:
+        contents: Iterable of story contents.
+        workers (int, optional): Number of worker processes. Defaults to the CPU count.
+        chunksize (int, optional): Documents sent to a worker at a time. Defaults to
+            spreading the batch over roughly four chunks per worker.
+        lexicon (Lexicon, optional): Vocabulary to tokenize against.
+
+    Returns:
+        list: The token lists, in the same order as contents.
+    """
+    contents = list(contents)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(contents) < MIN_POOL_BATCH:
+        return [preprocess(content, lexicon) for content in contents]
+    if chunksize is None:
+        chunksize = max(1, len(contents) // (workers * 4))
+    task = functools.partial(preprocess, lexicon=lexicon)
+    return list(_get_pool(workers).map(task, contents, chunksize=chunksize))
+
+
+# One pass over the content: bracketed names, escapes, a dangling bracket, words,
+# and runs of everything else. Bracket spans stop at the first closing bracket.
+TOKEN_RE = re.compile(
+    r"\[(?P<name>[^\]]*)\]"
+    r"|\{(?P<escaped>[^}]*)\}"
+    r"|(?P<error>[\[{])"
+    r"|(?P<word>\w+)"
+    r"|(?P<other>[^\w\[{]+)"
+)
+CAPITAL_RE = re.compile(r"[A-Z]")
+BRACKETS = {"[": "]", "{": "}"}
+
+
+def _scan(chunks, lexicon: Lexicon = LEXICON):
+    """
+    Yields raw (type, content) tokens from an iterable of text chunks in a single pass.
+
+    A word touching the end of the buffered text, or a bracket that has not been
+    closed yet, is held back until the next chunk arrives, so names, escapes and
+    words may span chunk boundaries.
+    """
+    output = []
+    rest = ""
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        if not final:
+            if rest[:1] in ("[", "{") and BRACKETS[rest[0]] not in chunk:
+                # Still waiting on the closing bracket, no need to rescan
+                rest += chunk
+                continue
+            rest += chunk
+
+        held = len(rest)
+        for match in TOKEN_RE.finditer(rest):
+            kind = match.lastgroup
+            if not final and (
+                kind == "error" or (kind == "word" and match.end() == len(rest))
+            ):
+                held = match.start()
+                break
+            if kind == "other":
+                output.append(match.group())
+                continue
+            if kind == "word":
+                w = match.group()
+                w = lexicon.canonical(w)
+                if CAPITAL_RE.search(w) is None and w in lexicon.words:
+                    output.append(w)
+                    continue
+
+            text = "".join(output)
+            output = []
+            yield ("tokipona", text)
+            if kind == "word":
+                if CAPITAL_RE.search(w) is not None:
+                    yield ("name", {"name": w})
+                else:
+                    yield ("illegal", w)
+            elif kind == "name":
+                yield ("name", split_fancy_names(match.group("name"), lexicon))
+            elif kind == "escaped":
+                yield ("escaped", match.group("escaped"))
+            else:
+                # Unterminated bracket: the rest of the text is an error, and the
+                # text before it is repeated as an error as the old scanner did.
+                yield ("error", rest[match.start():])
+                if len(text) > 0:
+                    yield ("error", text)
+                return
+        rest = rest[held:]
 
     if len(output) > 0:
-        tokens.append((token_type, output)) #.rstrip()))
+        yield ("tokipona", "".join(output))
+
 
-    last_tok = None
-    buffer = []
+def _merge(tokens):
+    """Merges consecutive tokens of the same type"""
+    pending = None
     for tok in tokens:
-        if tok[0] in ["tokipona", "illegal", "escaped", "name"]:
-            if last_tok == tok[0]:
-                if (
-                    last_tok == "name"
-                    and "toki_name" in tok[1]
-                    and tok[1]["toki_name"] is not None
-                ):
-                    buffer[-1] = (
-                        tok[0],
-                        {
-                            "name": buffer[-1][1]["name"] + tok[1]["name"],
-                            "toki_name": tok[1]["toki_name"],
-                        },
-                    )
-                else:
-                    buffer[-1] = (tok[0], buffer[-1][1] + tok[1])
+        if (
+            pending is not None
+            and pending[0] == tok[0]
+            and tok[0] in ["tokipona", "illegal", "escaped", "name"]
+        ):
+            if tok[0] == "name" and "toki_name" in tok[1] and tok[1]["toki_name"] is not None:
+                pending = (
+                    tok[0],
+                    {
+                        "name": pending[1]["name"] + tok[1]["name"],
+                        "toki_name": tok[1]["toki_name"],
+                    },
+                )
             else:
-                buffer.append(tok)
-        else:
-            buffer.append(tok)
-        last_tok = tok[0]
-
-    # Handle whitespace and punctuation
-    final_buffer = []
-    for tok in buffer:
-        if tok[0] in ["tokipona", "illegal", "escaped"] and tok[1].strip() == "":
-            # If the token is just whitespace or punctuation
-            if final_buffer and final_buffer[-1][0] in [
-                "tokipona",
-                "illegal",
-                "escaped",
-            ]:
-                # Add it to the previous token if one exists
-                final_buffer[-1] = (final_buffer[-1][0], final_buffer[-1][1] + tok[1])
-            elif final_buffer and final_buffer[-1][0] in ["name"]:
-                foo = final_buffer[-1]
-                foo[1]["name"] += tok[1]
-                final_buffer[-1] = foo
-                # final_buffer[-1] = (final_buffer[-1][0], final_buffer[-1][1] + tok[1])
+                pending = (tok[0], pending[1] + tok[1])
+            continue
+        if pending is not None:
+            yield pending
+        pending = tok
+    if pending is not None:
+        yield pending
+
+
+def _absorb_whitespace(tokens):
+    """Folds whitespace and punctuation only tokens into the token before them"""
+    pending = None
+    for tok in tokens:
+        if (
+            pending is not None
+            and tok[0] in ["tokipona", "illegal", "escaped"]
+            and tok[1].strip() == ""
+        ):
+            if pending[0] in ["tokipona", "illegal", "escaped"]:
+                pending = (pending[0], pending[1] + tok[1])
+                continue
+            elif pending[0] == "name":
+                pending[1]["name"] += tok[1]
+                continue
+        if pending is not None:
+            yield pending
+        pending = tok
+    if pending is not None:
+        yield pending
+
+
+def iter_tokens(text, lexicon: Lexicon = LEXICON):
+    """
+    Tokenizes toki pona text, yielding each token as soon as it is final.
+
+    Args:
+        text: A string, or any iterable of text chunks such as an open file.
+        lexicon (Lexicon, optional): Vocabulary to tokenize against.
+
+    Yields:
+        dict: Tokens of the same shape as those returned by _preprocess.
+
+    Only the pending token and a partial word or bracket are kept in memory,
+    except that an unterminated bracket swallows the rest of the input.
+    Markdown is not handled here; see preprocess.
+    """
+    if isinstance(text, str):
+        text = [text]
+    for tok in _absorb_whitespace(_merge(_scan(text, lexicon))):
+        yield {"type": tok[0], "content": tok[1]}
+
+
+def _preprocess(content: str, lexicon: Lexicon = LEXICON):
+    return list(iter_tokens(content, lexicon))
+
+
+# Compact token streams. Layout, with varint integers and length prefixed UTF-8:
+#   version byte, token count, one type code byte per token,
+#   string table (count, strings), name table (count, then per name: name,
+#   a toki_name byte of NAME_* and the toki name if present),
+#   then per token: a name index, a string index, or for SPAN tokens the gap
+#   after the previous span and the length, in code points of the content.
+COMPACT_TOKENS_VERSION = 1
+TOKEN_TYPES = ("tokipona", "illegal", "escaped", "name", "markdown", "error")
+TOKEN_CODES = {name: code for code, name in enumerate(TOKEN_TYPES)}
+SPAN = 0x80
+NAME_NO_TOKI_NAME, NAME_NULL_TOKI_NAME, NAME_TOKI_NAME = range(3)
+# How far past the previous span a token's text is looked for in the content
+SPAN_WINDOW = 256
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_string(out: bytearray, string: str):
+    encoded = string.encode("utf-8")
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _read_string(data: bytes, pos: int) -> tuple:
+    length, pos = _read_varint(data, pos)
+    return data[pos : pos + length].decode("utf-8"), pos + length
+
+
+def encode_tokens(tokens: list, content: str) -> bytes:
+    """
+    Packs a token stream into the compact format.
+
+    Text found in content near where the previous token left off is stored as
+    an offset and length, names are stored once in a name table and any other
+    text once in a string table.
+
+    Args:
+        tokens (list): Tokens as returned by preprocess.
+        content (str): The content the tokens were produced from.
+
+    Raises:
+        ValueError: If a token has a type or name fields the format can't hold.
+    """
+    codes = bytearray()
+    operands = bytearray()
+    strings = {}
+    names = {}
+    cursor = 0
+    for tok in tokens:
+        code = TOKEN_CODES.get(tok["type"])
+        text = tok["content"]
+        if code is None:
+            raise ValueError(f"Unknown token type {tok['type']!r}")
+        if code == TOKEN_CODES["name"]:
+            if not isinstance(text, dict) or not set(text) <= {"name", "toki_name"}:
+                raise ValueError(f"Unsupported name {text!r}")
+            if "toki_name" not in text:
+                name = (text["name"], NAME_NO_TOKI_NAME, None)
+            elif text["toki_name"] is None:
+                name = (text["name"], NAME_NULL_TOKI_NAME, None)
             else:
-                # If it's the first token, keep it as is
-                final_buffer.append(tok)
+                name = (text["name"], NAME_TOKI_NAME, text["toki_name"])
+            codes.append(code)
+            _write_varint(operands, names.setdefault(name, len(names)))
+            continue
+        if not isinstance(text, str):
+            raise ValueError(f"Unsupported token content {text!r}")
+        start = -1
+        if code != TOKEN_CODES["markdown"]:
+            start = content.find(text, cursor, cursor + SPAN_WINDOW + len(text))
+        if start >= 0:
+            codes.append(code | SPAN)
+            _write_varint(operands, start - cursor)
+            _write_varint(operands, len(text))
+            cursor = start + len(text)
         else:
-            final_buffer.append(tok)
-    return [{"type": tok[0], "content": tok[1]} for tok in final_buffer]
-    # markdown_buffer = []
-    # for tok in final_buffer:
-        # if markdown_buffer and tok[0] == markdown_buffer[-1][0]:
-            # if markdown_buffer[-1][0] == "name":
-                # if "toki_name" not in markdown_buffer[-1][1]:
-                    # if "toki_name" not in tok[1]:
-                        # newname = markdown_buffer[-1][1]["name"] + tok[1]["name"]
-                        # markdown_buffer[-1] = ("name", {"name": newname})
-                        # continue
-            # else:
-                # markdown_buffer[-1] = (tok[0], markdown_buffer[-1][1] + tok[1])
-                # continue
-        # markdown_buffer.append(tok)
-# 
+            codes.append(code)
+            _write_varint(operands, strings.setdefault(text, len(strings)))
+
+    out = bytearray([COMPACT_TOKENS_VERSION])
+    _write_varint(out, len(codes))
+    out += codes
+    _write_varint(out, len(strings))
+    for string in strings:
+        _write_string(out, string)
+    _write_varint(out, len(names))
+    for name, kind, toki_name in names:
+        _write_string(out, name)
+        out.append(kind)
+        if kind == NAME_TOKI_NAME:
+            _write_string(out, toki_name)
+    return bytes(out + operands)
+
+
+def decode_tokens(data: bytes, content: str) -> list:
+    """
+    Unpacks a token stream packed by encode_tokens.
+
+    Args:
+        data (bytes): The packed tokens.
+        content (str): The content the tokens were produced from.
+
+    Returns:
+        list: The tokens as preprocess returns them.
+    """
+    if data[0] != COMPACT_TOKENS_VERSION:
+        raise ValueError(f"Unsupported compact tokens version {data[0]}")
+    count, pos = _read_varint(data, 1)
+    codes = data[pos : pos + count]
+    pos += count
+    string_count, pos = _read_varint(data, pos)
+    strings = []
+    for _ in range(string_count):
+        string, pos = _read_string(data, pos)
+        strings.append(string)
+    name_count, pos = _read_varint(data, pos)
+    names = []
+    for _ in range(name_count):
+        name, pos = _read_string(data, pos)
+        kind = data[pos]
+        pos += 1
+        if kind == NAME_NO_TOKI_NAME:
+            names.append({"name": name})
+        elif kind == NAME_NULL_TOKI_NAME:
+            names.append({"name": name, "toki_name": None})
+        else:
+            toki_name, pos = _read_string(data, pos)
+            names.append({"name": name, "toki_name": toki_name})
+
+    tokens = []
+    cursor = 0
+    for code in codes:
+        token_type = TOKEN_TYPES[code & ~SPAN]
+        if code & SPAN:
+            gap, pos = _read_varint(data, pos)
+            length, pos = _read_varint(data, pos)
+            cursor += gap
+            text = content[cursor : cursor + length]
+            cursor += length
+        else:
+            index, pos = _read_varint(data, pos)
+            # Each token gets its own name dict, as preprocess returns them
+            text = dict(names[index]) if token_type == "name" else strings[index]
+        tokens.append({"type": token_type, "content": text})
+    return tokens
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 20 * 1024 * 1024))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Formats stored as uploaded; anything else Pillow can read is re-encoded to PNG.
+# Pillow reads most phone photos as MPO: a JPEG with more images after it.
+IMAGE_FORMATS = {"JPEG": ".jpg", "MPO": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+
+# Widths of the WebP variants made of each image, for story cards and story pages
+IMAGE_WIDTHS = sorted(int(width) for width in os.environ.get("IMAGE_WIDTHS", "480,960").split(","))
+VARIANT_QUALITY = 80
+
+# Copying, decoding and encoding images all happen here, off the event loop
+image_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("IMAGE_WORKERS", 2)), thread_name_prefix="images"
+)
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def copy_upload(source, path: str, max_bytes: int = MAX_IMAGE_BYTES) -> tuple:
+    """
+    Copies an upload to path in fixed-size chunks, hashing it on the way.
+
+    Raises:
+        ImageTooLarge: If the upload is bigger than max_bytes. Nothing is left at path.
+
+    Returns:
+        tuple: The sha256 hex digest and size of the upload.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as file:
+        try:
+            while chunk := source.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageTooLarge(f"Images can be at most {max_bytes} bytes")
+                digest.update(chunk)
+                file.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+    return digest.hexdigest(), size
+
+
+def validate_image(path: str) -> str:
+    """
+    Checks that path holds an image that decodes in full, re-encoding it to PNG
+    if it isn't in a format browsers display.
+
+    Raises:
+        InvalidImage: If the file isn't a readable image or has too many pixels.
+
+    Returns:
+        str: The file extension for the image's format.
+    """
+    try:
+        with Image.open(path) as image:
+            if image.width * image.height > MAX_IMAGE_PIXELS:
+                raise InvalidImage(f"Images can have at most {MAX_IMAGE_PIXELS} pixels")
+            image.load()
+            if image.format in IMAGE_FORMATS:
+                return IMAGE_FORMATS[image.format]
+            if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+                image = image.convert("RGBA")
+            image.save(path, format="PNG")
+            return IMAGE_FORMATS["PNG"]
+    except (UnidentifiedImageError, OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise InvalidImage("Not a valid image") from e
+
+
+def image_path(directory: str, image_id: str) -> str | None:
+    """Returns the path of a stored image, or None if there is no such image"""
+    if os.path.basename(image_id) != image_id or image_id.startswith("."):
+        return None
+    path = os.path.join(directory, image_id)
+    return path if os.path.isfile(path) else None
+
+
+def variant_path(directory: str, image_id: str, width: int) -> str:
+    return os.path.join(directory, "variants", f"{os.path.splitext(image_id)[0]}-{width}.webp")
+
+
+def variant_width(width: int) -> int:
+    """Returns the smallest variant width at least width, or the largest there is"""
+    return next((w for w in IMAGE_WIDTHS if w >= width), IMAGE_WIDTHS[-1])
+
+
+def make_variant(source: str, path: str, width: int) -> bool:
+    """
+    Writes a WebP copy of an image scaled down to at most width pixels wide.
+
+    Returns:
+        bool: False for animated images and files Pillow can't decode, e.g.
+        uploads from before images were validated, which are only served as
+        uploaded.
+    """
+    tmp_path = f"{path}.{uuid.uuid4()}.tmp"
+    try:
+        with Image.open(source) as image:
+            # The other images of an MPO are previews or depth maps, not animation
+            if getattr(image, "n_frames", 1) > 1 and image.format != "MPO":
+                return False
+            image = ImageOps.exif_transpose(image)
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.save(tmp_path, format="WEBP", quality=VARIANT_QUALITY)
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+def make_variants(directory: str, image_id: str):
+    source = os.path.join(directory, image_id)
+    for width in IMAGE_WIDTHS:
+        if not make_variant(source, variant_path(directory, image_id, width), width):
+            return
+
+
+def _report(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Failed to make image variants: {future.exception()!r}")
+
+
+async def get_variant(directory: str, image_id: str, width: int) -> str | None:
+    """
+    Returns the path of the variant of an image for a width, making it now if
+    it doesn't exist yet. Returns None for images served only as uploaded,
+    including files that don't decode.
+    """
+    path = variant_path(directory, image_id, width)
+    if os.path.isfile(path):
+        return path
+    loop = asyncio.get_running_loop()
+    source = os.path.join(directory, image_id)
+    if await loop.run_in_executor(image_pool, make_variant, source, path, width):
+        return path
+    return None
+
+
+async def save_upload(upload, directory: str) -> dict:
+    """
+    Streams an UploadFile into directory as a validated image, named by the
+    sha256 of the upload so the same image is only ever stored once. Its
+    variants are made in the background.
+
+    Raises:
+        ImageTooLarge, InvalidImage
+
+    Returns:
+        dict: The stored image_id, with the sha256 and size of the upload.
+    """
+    loop = asyncio.get_running_loop()
+    tmp_path = os.path.join(directory, f".{uuid.uuid4()}.upload")
+    digest, size = await loop.run_in_executor(image_pool, copy_upload, upload.file, tmp_path)
+    for extension in set(IMAGE_FORMATS.values()):
+        if os.path.isfile(os.path.join(directory, digest + extension)):
+            os.remove(tmp_path)
+            return {"image_id": digest + extension, "sha256": digest, "size": size}
+    try:
+        extension = await loop.run_in_executor(image_pool, validate_image, tmp_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    image_id = digest + extension
+    os.replace(tmp_path, os.path.join(directory, image_id))
+    loop.run_in_executor(image_pool, make_variants, directory, image_id).add_done_callback(_report)
+    return {"image_id": image_id, "sha256": digest, "size": size}
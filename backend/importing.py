@@ -1,25 +1,76 @@
+import asyncio
 import json
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 import os
-from ilo import preprocess
+from ilo import LEXICON, decode_tokens, encode_tokens, preprocess_many
+from tokencache import content_hash, token_cache
+from responsecache import response_cache
+from corpus import stories_added
+from instances import REGISTRY_COLLECTION, InstanceRegistry, collection_name
+from workers import tokenize_pool
 import sys
 from datetime import datetime, UTC
 
-def preprocess_story(story, summarize=False):
+# How tokens are stored: "compact" (ilo.encode_tokens) or "legacy" (a list of dicts)
+TOKEN_STORAGE = os.environ.get("TOKEN_STORAGE", "compact")
+
+
+def stored_tokens(story):
+    """Returns a stored story's tokens as a list, whichever way they are stored"""
+    tokens = story.get("tokenised")
+    if isinstance(tokens, bytes):
+        return decode_tokens(tokens, story["content"])
+    return tokens
+
+
+def pack_tokens(tokens, content, storage=None):
+    """
+    Returns tokens in the shape they are stored in, by default TOKEN_STORAGE.
+
+    Tokens the compact format can't hold, e.g. ones sent by a client with a type
+    of its own, stay a list.
+    """
+    if (storage or TOKEN_STORAGE) != "compact" or not isinstance(tokens, list):
+        return tokens
+    try:
+        return encode_tokens(tokens, content)
+    except (ValueError, KeyError):
+        return tokens
+
+def has_current_tokens(story, digest, lexicon=LEXICON):
+    """True if a story comes with tokens this tokenizer made for its content"""
+    return (
+        story.get("tokenised") is not None
+        and story.get("content_hash") == digest
+        and story.get("tokenizer_version") == lexicon.version
+    )
+
+def preprocess_story(story, summarize=False, tokenised=None, lexicon=LEXICON):
     """
     Preprocess a story by tokenizing content and generating summary if needed
     
     Args:
         story: Dictionary containing story data
         summarize: Boolean to force summary generation
+        tokenised: Tokens already produced for the content, if any
+        lexicon: Vocabulary to tokenize against
     
     Returns:
         Processed story dictionary
     """
-    story["tokenised"] = preprocess(story["content"])
+    digest = content_hash(story["content"])
+    if tokenised is None and has_current_tokens(story, digest, lexicon):
+        # Already tokenized by this tokenizer, e.g. a re-import of an export
+        tokenised = stored_tokens(story)
+    if tokenised is None:
+        tokenised = token_cache.preprocess(story["content"], digest, lexicon)
+    story["tokenised"] = tokenised
+    story["content_hash"] = digest
+    story["tokenizer_version"] = lexicon.version
     
-    if summarize or "summary" not in story or len(story.get('summary', '')) == 0:
+    if summarize or not story.get('summary'):
         summary = [t['content'] for t in story["tokenised"] if t['type'] != 'markdown']
         summary = [t['name'] if isinstance(t, dict) and 'name' in t else t for t in summary]
         summary = " ".join(summary)[:100] + "..."
@@ -31,44 +82,141 @@ def preprocess_story(story, summarize=False):
     # If it's a string, convert to datetime
     elif isinstance(story["date"], str):
         story["date"] = datetime.fromisoformat(story["date"].replace('Z', '+00:00'))
-    
+
+    story["tokenised"] = pack_tokens(story["tokenised"], story["content"])
     return story
 
-async def import_story(story_data, db, delete=False, summarize=False):
+def preprocess_stories(stories_data, summarize=False, lexicon=LEXICON):
+    """Preprocesses a batch of stories in place, tokenizing them all at once"""
+    tokenised = token_cache.preprocess_many(
+        [story["content"] for story in stories_data], lexicon=lexicon
+    )
+    for story, tokens in zip(stories_data, tokenised):
+        preprocess_story(story, summarize, tokenised=tokens, lexicon=lexicon)
+    return stories_data
+
+def _preprocess_with_tokens(stories_data, tokenised, summarize, lexicon):
+    return [
+        preprocess_story(story, summarize, tokenised=tokens, lexicon=lexicon)
+        for story, tokens in zip(stories_data, tokenised)
+    ]
+
+async def tokenize_contents(contents, lexicon=LEXICON, pool=tokenize_pool):
+    """
+    Tokenizes contents for an async handler. Cache misses are tokenized together
+    in one task on the pool.
+
+    Raises:
+        workers.PoolSaturated, workers.TaskTimeout
+    """
+    contents = list(contents)
+    digests = [content_hash(content) for content in contents]
+    results = [token_cache.get(digest, lexicon) for digest in digests]
+    missing = [i for i, tokens in enumerate(results) if tokens is None]
+    if missing:
+        tokenised = await pool.run(preprocess_many, [contents[i] for i in missing], 1, None, lexicon)
+        for i, tokens in zip(missing, tokenised):
+            token_cache.put(digests[i], tokens, lexicon)
+            results[i] = tokens
+    return results
+
+async def preprocess_stories_async(stories_data, summarize=False, lexicon=LEXICON, pool=tokenize_pool):
+    """
+    preprocess_stories for async handlers, with the tokenizing and summarizing
+    done on the pool. Returns the preprocessed stories, which may be copies.
+
+    Raises:
+        workers.PoolSaturated, workers.TaskTimeout
+    """
+    current = [
+        has_current_tokens(story, content_hash(story["content"]), lexicon) for story in stories_data
+    ]
+    stale = [story["content"] for story, is_current in zip(stories_data, current) if not is_current]
+    fresh = iter(await tokenize_contents(stale, lexicon, pool))
+    # None leaves preprocess_story to reuse the tokens a story already has
+    tokenised = [None if is_current else next(fresh) for is_current in current]
+    return await pool.run(_preprocess_with_tokens, stories_data, tokenised, summarize, lexicon)
+
+async def import_story(story_data, db, delete=False, summarize=False, lexicon=LEXICON):
     # Convert single story dict to list for processing
     story = story_data[0] if isinstance(story_data, list) else story_data
     
     print("Preprocessing story")
-    story = preprocess_story(story, summarize)
+    story = (await preprocess_stories_async([story], summarize, lexicon))[0]
 
     # Insert single story and return the complete document
     result = await db.insert_one(story)
+    response_cache.invalidate(db.name)
     inserted_story = await db.find_one({"_id": result.inserted_id})
+    stories_added(db.name, [inserted_story])
     return inserted_story
 
-def import_stories(stories_data, db, delete=False, summarize=False):
+def import_stories(stories_data, db, delete=False, summarize=False, lexicon=LEXICON):
     if delete:
         print("Deleting existing stories")
         db.drop()
+        response_cache.invalidate(db.name)
 
     # Preprocess all stories
-    for story in stories_data:
-        print("Preprocessing story")
-        story = preprocess_story(story, summarize)
+    print(f"Preprocessing {len(stories_data)} stories")
+    preprocess_stories(stories_data, summarize, lexicon)
 
     # Insert all stories at once
-    return db.insert_many(stories_data)
+    result = db.insert_many(stories_data)
+    response_cache.invalidate(db.name)
+    return result
 
     # print(f"Imported {len(stories_data)} stories into the database.")
 
+def migrate_tokens(db, storage="compact", batch_size=500):
+    """
+    Rewrites the tokens of every story in a collection into one storage shape.
+
+    Args:
+        db: The stories collection.
+        storage: "compact" or "legacy".
+        batch_size: Number of stories to update per bulk write.
+
+    Returns:
+        The number of stories rewritten.
+    """
+    migrated = 0
+    updates = []
+    for story in db.find({"tokenised": {"$ne": None}}, {"content": 1, "tokenised": 1}):
+        tokens = pack_tokens(stored_tokens(story), story["content"], storage)
+        if type(tokens) is type(story["tokenised"]):
+            continue
+        updates.append(UpdateOne({"_id": story["_id"]}, {"$set": {"tokenised": tokens}}))
+        if len(updates) == batch_size:
+            migrated += db.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        migrated += db.bulk_write(updates, ordered=False).modified_count
+    response_cache.invalidate(db.name)
+    return migrated
+
+async def register_instance(instance, dropped=False):
+    """
+    Records an instance in the registry the API reads, so it is served without
+    waiting for a restart, and gives its collection STORY_INDEXES. A dropped
+    collection lost its indexes, so they are built again.
+    """
+    db = AsyncIOMotorClient(os.getenv("MONGO_URI"))["stories"]
+    registry = InstanceRegistry(db, db[REGISTRY_COLLECTION])
+    if dropped:
+        await registry.dropped(instance)
+    await registry.ensure(instance)
+
 def import_file(file_path, delete=False, summarize=False, instance="stories"):
     db = MongoClient(os.getenv("MONGO_URI"))["stories"]
     with open(file_path, "r", encoding="utf-8") as file:
         stories_data = json.load(file)
-    import_stories(stories_data, db[instance], delete=delete, summarize=summarize)
+    import_stories(stories_data, db[collection_name(instance)], delete=delete, summarize=summarize)
+    asyncio.run(register_instance(instance, dropped=delete))
 
 if __name__ == "__main__":
     delete = False
+    instance = "stories"
     if "-i" in sys.argv:
         instance = sys.argv[sys.argv.index("-i") + 1]
         sys.argv.remove("-i")
@@ -80,6 +228,11 @@ if __name__ == "__main__":
     if "-s" in sys.argv:
         summarize = True
         sys.argv.remove("-s")
-    if len(sys.argv) > 1:
+    if "-m" in sys.argv:
+        # Convert stored tokens, e.g. python importing.py -i stories -m compact
+        storage = sys.argv[sys.argv.index("-m") + 1]
+        db = MongoClient(os.getenv("MONGO_URI"))["stories"]
+        print(f"Migrated {migrate_tokens(db[collection_name(instance)], storage)} stories to {storage} tokens")
+    elif len(sys.argv) > 1:
         input_file = sys.argv[1]
         import_file(input_file, delete=delete, summarize=summarize, instance=instance)
@@ -0,0 +1,137 @@
+import asyncio
+import functools
+import time
+from datetime import datetime, UTC
+
+from pymongo import IndexModel
+
+from ilo import LEXICON, Lexicon
+
+# Bump when STORY_INDEXES changes so every instance gets the new indexes once
+INDEXES_VERSION = 1
+# Indexes every story collection needs. The feed index also serves date ranges
+# and the oldest first export, and MongoDB always indexes _id.
+STORY_INDEXES = [IndexModel([("date", -1), ("_id", -1)], name="feed")]
+# Seconds an instance that doesn't exist is remembered as missing
+MISSING_TTL = 10
+# Instance collection names never contain a dot, so this can't clash with one
+REGISTRY_COLLECTION = "instances.registry"
+
+
+@functools.lru_cache(maxsize=4096)
+def collection_name(instance: str) -> str:
+    """Returns the collection holding an instance's stories"""
+    if instance == "default" or instance == "localhost":
+        return "stories"  # Use original collection for default instance
+    return "".join(c for c in instance if c.isalnum() or c in ("-", "_")).lower()
+
+
+class Instance:
+    __slots__ = ("name", "collection", "lexicon", "settings")
+
+    def __init__(self, name: str, collection, settings: dict):
+        self.name = name
+        self.collection = collection
+        self.settings = settings
+        extra_words = settings.get("extra_words")
+        self.lexicon = Lexicon(extra_words) if extra_words else LEXICON
+
+
+class InstanceRegistry:
+    """
+    The instances there are, recorded in a registry collection with their
+    settings, and cached in process with their collection handles.
+
+    An instance is set up the first time it is written to: it gets a registry
+    document, and its collection gets STORY_INDEXES. The registry notes which
+    version of the indexes was built, so each instance is only indexed once
+    however many API processes there are.
+
+    Args:
+        db: The database holding the story collections.
+        registry: The registry collection.
+    """
+
+    def __init__(self, db, registry):
+        self.db = db
+        self.registry = registry
+        self._instances = {}
+        self._missing = {}
+        self._locks = {}
+
+    def _instance(self, document: dict) -> Instance:
+        instance = Instance(document["_id"], self.db[document["_id"]], document.get("settings") or {})
+        self._instances[instance.name] = instance
+        self._missing.pop(instance.name, None)
+        return instance
+
+    async def get(self, instance: str) -> Instance | None:
+        """Returns an instance, or None if nothing was ever written to it"""
+        name = collection_name(instance)
+        cached = self._instances.get(name)
+        if cached is not None:
+            return cached
+        if self._missing.get(name, 0) > time.monotonic():
+            return None
+        # May have been created by another API process
+        document = await self.registry.find_one({"_id": name})
+        if document is None or document.get("indexes_version") != INDEXES_VERSION:
+            self._missing[name] = time.monotonic() + MISSING_TTL
+            return None
+        return self._instance(document)
+
+    async def ensure(self, instance: str) -> Instance:
+        """Returns an instance, setting it up first if it is new"""
+        name = collection_name(instance)
+        cached = self._instances.get(name)
+        if cached is not None:
+            return cached
+        if not name:
+            raise ValueError(f"Not a valid instance name: {instance!r}")
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            if name in self._instances:
+                return self._instances[name]
+            document = await self.registry.find_one_and_update(
+                {"_id": name},
+                {"$setOnInsert": {"created_at": datetime.now(UTC), "settings": {}}},
+                upsert=True,
+                return_document=True,
+            )
+            if document.get("indexes_version") != INDEXES_VERSION:
+                await self.db[name].create_indexes(STORY_INDEXES)
+                await self.registry.update_one(
+                    {"_id": name}, {"$set": {"indexes_version": INDEXES_VERSION}}
+                )
+                print(f"{name}: indexed")
+            return self._instance(document)
+
+    async def dropped(self, instance: str):
+        """Notes that an instance's collection was dropped, taking its indexes with it"""
+        name = collection_name(instance)
+        self._instances.pop(name, None)
+        await self.registry.update_one({"_id": name}, {"$unset": {"indexes_version": ""}})
+
+    async def load(self, names=()):
+        """Caches every registered instance, and sets up the given ones"""
+        async for document in self.registry.find({"indexes_version": INDEXES_VERSION}):
+            self._instance(document)
+        for name in names:
+            await self.ensure(name)
+
+    async def stats(self) -> list:
+        """Returns the document count and sizes of every registered instance"""
+        stats = []
+        async for document in self.registry.find({}, {"_id": 1}):
+            storage = await self.db[document["_id"]].aggregate(
+                [{"$collStats": {"storageStats": {}}}]
+            ).to_list(1)
+            storage = storage[0]["storageStats"] if storage else {}
+            stats.append({
+                "instance": document["_id"],
+                "count": storage.get("count", 0),
+                "size": storage.get("size", 0),
+                "storage_size": storage.get("storageSize", 0),
+                "index_size": storage.get("totalIndexSize", 0),
+            })
+        return stats
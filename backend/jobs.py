@@ -0,0 +1,204 @@
+import asyncio
+import os
+import traceback
+import uuid
+from datetime import datetime, timedelta, UTC
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from corpus import stories_added
+from importing import preprocess_stories_async
+from responsecache import response_cache
+from workers import PoolSaturated
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+# Seconds a worker holds a job before another worker may take it over
+INGEST_LEASE = float(os.environ.get("INGEST_LEASE", 120))
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", 5))
+INGEST_POLL_INTERVAL = float(os.environ.get("INGEST_POLL_INTERVAL", 1))
+# Seconds finished jobs are kept; dead jobs are kept until removed by hand
+INGEST_RETENTION = int(os.environ.get("INGEST_RETENTION", 7 * 24 * 3600))
+
+QUEUED, RUNNING, DONE, DEAD = "queued", "running", "done", "dead"
+
+JOB_INDEXES = [
+    IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="claim"),
+    IndexModel([("finished_at", ASCENDING)], name="retention", expireAfterSeconds=INGEST_RETENTION),
+]
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+class IngestQueue:
+    """
+    Story ingest jobs kept in a MongoDB collection and run by async workers.
+
+    A job holds the story to create and the id it will get. Workers claim a job
+    by taking a lease on it, preprocess the story on the tokenize pool and insert
+    it under that id, so a job that is run twice still creates one story. Failed
+    jobs are retried with exponential backoff, and after max_attempts are left
+    dead with their last error. A job whose worker died is taken over once its
+    lease runs out.
+
+    Args:
+        jobs: The jobs collection.
+        get_instance (callable): Awaitable returning the instances.Instance to create in.
+    """
+
+    def __init__(
+        self,
+        jobs,
+        get_instance,
+        workers: int = INGEST_WORKERS,
+        lease: float = INGEST_LEASE,
+        max_attempts: int = INGEST_MAX_ATTEMPTS,
+        poll_interval: float = INGEST_POLL_INTERVAL,
+    ):
+        self.jobs = jobs
+        self.get_instance = get_instance
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_id = uuid.uuid4().hex
+        self.processed = 0
+        self.retried = 0
+        self.dead = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def ensure_indexes(self):
+        await self.jobs.create_indexes(JOB_INDEXES)
+
+    async def enqueue(self, instance: str, story: dict, summarize: bool = False) -> dict:
+        """Persists a job to create a story and returns it"""
+        now = _now()
+        job = {
+            "_id": ObjectId(),
+            "instance": instance,
+            "story": story,
+            "summarize": summarize,
+            "story_id": ObjectId(),
+            "status": QUEUED,
+            "attempts": 0,
+            "lease_until": now,
+            "created_at": now,
+            "updated_at": now,
+            "error": None,
+        }
+        await self.jobs.insert_one(job)
+        self._wakeup.set()
+        return job
+
+    async def get(self, job_id: ObjectId) -> dict | None:
+        return await self.jobs.find_one({"_id": job_id}, {"story": 0})
+
+    async def claim(self) -> dict | None:
+        """Leases the next job that is due, or one whose lease has run out"""
+        now = _now()
+        return await self.jobs.find_one_and_update(
+            {"status": {"$in": [QUEUED, RUNNING]}, "lease_until": {"$lte": now}},
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "lease_until": now + timedelta(seconds=self.lease),
+                    "worker": self.worker_id,
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("lease_until", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _finish(self, job: dict, update: dict):
+        # Only the worker holding the lease may settle the job
+        update["updated_at"] = _now()
+        await self.jobs.update_one(
+            {"_id": job["_id"], "worker": self.worker_id, "attempts": job["attempts"]},
+            {"$set": update},
+        )
+
+    async def process(self, job: dict):
+        try:
+            instance = await self.get_instance(job["instance"])
+            collection = instance.collection
+            story = (await preprocess_stories_async([job["story"]], job["summarize"], instance.lexicon))[0]
+            story["_id"] = job["story_id"]
+            try:
+                await collection.insert_one(story)
+            except DuplicateKeyError:
+                # Inserted by an earlier attempt that didn't get to record it
+                if await collection.find_one({"_id": story["_id"]}, {"_id": 1}) is None:
+                    raise
+            response_cache.invalidate(collection.name)
+            stories_added(collection.name, [story])
+        except PoolSaturated:
+            # Not the job's fault: put it back without using up an attempt
+            await self._finish(job, {
+                "status": QUEUED,
+                "attempts": job["attempts"] - 1,
+                "lease_until": _now() + timedelta(seconds=self.poll_interval),
+            })
+            return
+        except Exception as e:
+            error = "".join(traceback.format_exception_only(e)).strip()
+            if job["attempts"] >= self.max_attempts:
+                self.dead += 1
+                print(f"{job['instance']}: ingest job {job['_id']} is dead: {error}")
+                await self._finish(job, {"status": DEAD, "error": error, "lease_until": None})
+            else:
+                self.retried += 1
+                backoff = timedelta(seconds=2 ** job["attempts"])
+                await self._finish(job, {"status": QUEUED, "error": error, "lease_until": _now() + backoff})
+            return
+        self.processed += 1
+        print(f"{job['instance']}: CREATED  ", str(job["story_id"]))
+        await self._finish(job, {
+            "status": DONE,
+            "error": None,
+            "lease_until": None,
+            "finished_at": _now(),
+        })
+
+    async def work(self):
+        """Runs jobs until cancelled, polling while the queue is empty"""
+        while True:
+            try:
+                job = await self.claim()
+            except Exception as e:
+                print(f"Failed to claim an ingest job: {e!r}")
+                job = None
+            if job is not None:
+                try:
+                    await self.process(job)
+                except Exception as e:
+                    # Settling the job failed; it is taken over once its lease runs out
+                    print(f"{job['instance']}: failed to settle ingest job {job['_id']}: {e!r}")
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "processed": self.processed,
+            "retried": self.retried,
+            "dead": self.dead,
+        }
@@ -0,0 +1,123 @@
+import threading
+from collections import Counter
+
+import numpy as np
+
+from corpus import CorpusIndexes
+from ilo import LEXICON
+from importing import stored_tokens
+from search import walk
+
+
+class CoverageIndex:
+    """
+    How often each story of a collection uses each word of the lexicon, as a
+    stories by words float32 matrix, so a learner's known words can be checked
+    against every story with one matrix-vector product.
+
+    Words outside the lexicon count towards a story's total but can never be
+    known; names don't count at all. The rows of deleted stories are reused.
+    add_many and remove_many may be called from another thread while ranking.
+
+    Args:
+        lexicon (ilo.Lexicon): The words that get a column, in canonical spelling.
+    """
+
+    def __init__(self, lexicon=LEXICON, capacity: int = 1024):
+        self.lexicon = lexicon
+        self.columns = {word: column for column, word in enumerate(sorted(lexicon.words))}
+        self.counts = np.zeros((capacity, len(self.columns)), dtype=np.float32)
+        self.totals = np.zeros(capacity, dtype=np.float32)
+        self.ids = []
+        self.rows = {}
+        self.free = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _row(self, story_id) -> int:
+        if story_id in self.rows:
+            return self.rows[story_id]
+        if self.free:
+            row = self.free.pop()
+            self.ids[row] = story_id
+        else:
+            row = len(self.ids)
+            if row == len(self.totals):
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+                self.totals = np.concatenate([self.totals, np.zeros_like(self.totals)])
+            self.ids.append(story_id)
+        self.rows[story_id] = row
+        return row
+
+    def add_many(self, stories: list):
+        """Counts the words of stories, replacing any that are already counted"""
+        for story in stories:
+            tokens = stored_tokens(story)
+            if not tokens:
+                self.remove_many([story["_id"]])
+                continue
+            words = Counter(value for kind, value in walk(tokens, self.lexicon) if kind == "word")
+            known = [(self.columns[word], count) for word, count in words.items() if word in self.columns]
+            with self._lock:
+                row = self._row(story["_id"])
+                self.counts[row] = 0
+                if known:
+                    columns, counts = zip(*known)
+                    self.counts[row, list(columns)] = counts
+                self.totals[row] = sum(words.values())
+
+    def remove_many(self, story_ids: list):
+        with self._lock:
+            for story_id in story_ids:
+                row = self.rows.pop(story_id, None)
+                if row is not None:
+                    self.counts[row] = 0
+                    self.totals[row] = 0
+                    self.ids[row] = None
+                    self.free.append(row)
+
+    def known_mask(self, words) -> np.ndarray:
+        """Returns the column mask of the given words, ignoring ones not in the lexicon"""
+        mask = np.zeros(len(self.columns), dtype=np.float32)
+        for word in words:
+            column = self.columns.get(self.lexicon.canonical(word.lower()))
+            if column is not None:
+                mask[column] = 1
+        return mask
+
+    def readable(self, known: np.ndarray, min_coverage: float, skip: int = 0, limit: int = 20) -> tuple:
+        """
+        Ranks the stories at least min_coverage of whose words are known.
+
+        Stories are ordered by coverage to within 0.01%, then by row.
+
+        Args:
+            known (np.ndarray): Column mask from known_mask.
+
+        Returns:
+            tuple: The number of stories found, and (id, coverage, words)
+            triples for the requested page of them.
+        """
+        with self._lock:
+            size = len(self.ids)
+            totals = self.totals[:size].copy()
+            known_counts = self.counts[:size] @ known
+            ids = self.ids[:size]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coverage = np.where(totals > 0, known_counts / totals, -1)
+        rows = np.flatnonzero(coverage >= min_coverage)
+        # Coverage in whole basis points sorts as uint16, with a stable radix sort
+        points = 10000 - np.floor(coverage[rows] * 10000).astype(np.uint16)
+        rows = rows[np.argsort(points, kind="stable")][skip : skip + limit]
+        return len(points), [(ids[row], float(coverage[row]), int(totals[row])) for row in rows.tolist()]
+
+
+coverage_indexes = CorpusIndexes(CoverageIndex, {"content": 1, "tokenised": 1})
+
+
+async def readable_stories(instance, known: list, min_coverage: float, skip: int = 0, limit: int = 20) -> tuple:
+    """Ranks an instance's stories by how many of their words are known; see CoverageIndex.readable"""
+    index = await coverage_indexes.get(instance)
+    return index.readable(index.known_mask(known), min_coverage, skip, limit)
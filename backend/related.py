@@ -0,0 +1,353 @@
+import asyncio
+import itertools
+import math
+import os
+import threading
+import zlib
+from collections import Counter
+
+import numpy as np
+from pymongo import DeleteOne, ReplaceOne
+
+from corpus import CorpusIndexes
+from ilo import LEXICON
+from importing import stored_tokens
+from search import walk
+
+# Neighbours kept for each story
+RELATED_COUNT = int(os.environ.get("RELATED_COUNT", 10))
+# Names are hashed into this many columns, after the lexicon's words
+NAME_BUCKETS = 128
+# Stories whose neighbours are found per matrix product
+LINK_BATCH_SIZE = 32
+
+
+def _grow(array: np.ndarray, size: int, fill=0) -> np.ndarray:
+    if size <= len(array):
+        return array
+    grown = np.full((max(size, 2 * len(array)), *array.shape[1:]), fill, dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+class RelatedIndex:
+    """
+    Each story's nearest neighbours by cosine similarity of TF-IDF vectors over
+    the lexicon's words and the story's names.
+
+    Vectors are rows of a float32 matrix. Rows are only ever appended: an
+    edited story gets a new row and its old one is marked dead, until garbage
+    grows enough for the index to be built again. Stories are
+    vectorized as they are added, but their neighbours are found later by
+    update, in batches of rows multiplied against the whole matrix. A new
+    story also joins the lists of any stories it is nearer to than their
+    furthest neighbour, and stories that lose a neighbour to a delete are
+    found again, so lists never have to be rebuilt from scratch.
+
+    The IDF weights are fixed when the index is built with freeze; until then
+    rows hold the raw log term frequencies.
+
+    add_many and remove_many may be called while update runs in another
+    thread, but only one update may run at a time.
+
+    Args:
+        lexicon (ilo.Lexicon): The words that get a column, in canonical spelling.
+        count (int): Neighbours kept for each story.
+    """
+
+    def __init__(self, lexicon=LEXICON, count: int = RELATED_COUNT, capacity: int = 1024):
+        self.lexicon = lexicon
+        self.count = count
+        self.columns = {word: column for column, word in enumerate(sorted(lexicon.words))}
+        width = len(self.columns) + NAME_BUCKETS
+        self.vectors = np.zeros((capacity, width), dtype=np.float32)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.df = np.zeros(width)
+        self.idf = None
+        self.ids = []
+        self.rows = {}
+        self.neighbours = np.full((capacity, count), -1, dtype=np.int32)
+        self.scores = np.full((capacity, count), -np.inf, dtype=np.float32)
+        self.linked = np.zeros(capacity, dtype=bool)
+        self.unlinked = set()
+        self.dead = []
+        self.dirty = set()
+        self.removed = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _vector(self, tokens: list) -> np.ndarray:
+        counts = Counter()
+        for kind, value in walk(tokens, self.lexicon):
+            if kind == "word" and value in self.columns:
+                counts[self.columns[value]] += 1
+            elif kind == "name":
+                counts[len(self.columns) + zlib.crc32(value.encode("utf-8")) % NAME_BUCKETS] += 1
+        vector = np.zeros(self.vectors.shape[1], dtype=np.float32)
+        for column, count in counts.items():
+            vector[column] = 1 + math.log(count)
+        return vector
+
+    def _weigh(self, vectors: np.ndarray) -> np.ndarray:
+        vectors *= self.idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def freeze(self):
+        """Fixes the IDF weights from the stories added so far, and applies them"""
+        with self._lock:
+            size = len(self.ids)
+            self.idf = (np.log((1 + len(self.rows)) / (1 + self.df)) + 1).astype(np.float32)
+            self._weigh(self.vectors[:size])
+
+    def add_many(self, stories: list):
+        """Adds stories to be linked by update, replacing any that are already added"""
+        for story in stories:
+            tokens = stored_tokens(story)
+            vector = self._vector(tokens or [])
+            if self.idf is not None:
+                vector = self._weigh(vector[None, :])[0]
+            with self._lock:
+                self._remove(story["_id"])
+                row = len(self.ids)
+                self.vectors = _grow(self.vectors, row + 1)
+                self.alive = _grow(self.alive, row + 1, False)
+                self.vectors[row] = vector
+                self.alive[row] = True
+                self.df += vector > 0
+                self.ids.append(story["_id"])
+                self.rows[story["_id"]] = row
+                self.unlinked.add(row)
+
+    def _remove(self, story_id):
+        row = self.rows.pop(story_id, None)
+        if row is not None:
+            self.alive[row] = False
+            self.df -= self.vectors[row] > 0
+            self.unlinked.discard(row)
+            self.dead.append(row)
+
+    def remove_many(self, story_ids: list):
+        with self._lock:
+            for story_id in story_ids:
+                if story_id in self.rows:
+                    self._remove(story_id)
+                    self.removed.append(story_id)
+
+    def restore(self, documents: list):
+        """Takes neighbour lists stored by an earlier index, where they are still complete"""
+        with self._lock:
+            size = len(self.ids)
+            self._grow_lists(size)
+            expected = min(self.count, len(self.rows) - 1)
+            for document in documents:
+                row = self.rows.get(document["_id"])
+                if row is None:
+                    self.removed.append(document["_id"])
+                    continue
+                neighbours = [self.rows.get(story_id) for story_id in document["related"]]
+                if len(neighbours) < expected or None in neighbours:
+                    continue
+                self.neighbours[row] = -1
+                self.scores[row] = -np.inf
+                self.neighbours[row, : len(neighbours)] = neighbours
+                self.scores[row, : len(neighbours)] = document["scores"]
+                self.linked[row] = True
+                self.unlinked.discard(row)
+
+    def _grow_lists(self, size: int):
+        self.neighbours = _grow(self.neighbours, size, -1)
+        self.scores = _grow(self.scores, size, -np.inf)
+        self.linked = _grow(self.linked, size, False)
+
+    def is_linked(self, row: int) -> bool:
+        return row < len(self.linked) and bool(self.linked[row])
+
+    @property
+    def garbage(self) -> float:
+        """Share of the rows that are dead"""
+        return 1 - len(self.rows) / len(self.ids) if self.ids else 0.0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.unlinked or self.dead)
+
+    def update(self, rows: list = None, batch_size: int = LINK_BATCH_SIZE) -> int:
+        """
+        Finds the neighbours of the given rows, or else of up to batch_size of
+        the rows waiting for them, after dropping dead rows from every list.
+
+        Returns:
+            int: The number of rows still waiting for their neighbours.
+        """
+        with self._lock:
+            vectors, size = self.vectors, len(self.ids)
+            alive = self.alive[:size].copy()
+            dead, self.dead = self.dead, []
+            self._grow_lists(size)
+            if dead:
+                # Stories that lost a neighbour need theirs found again
+                lost = np.isin(self.neighbours[:size], dead).any(axis=1) & alive
+                self.linked[: size][lost] = False
+                self.unlinked.update(np.flatnonzero(lost).tolist())
+            if rows is None:
+                rows = list(itertools.islice(self.unlinked, batch_size))
+            else:
+                rows = [row for row in rows if row < size and alive[row]]
+        if rows:
+            self._link(np.array(rows), vectors[:size], alive)
+        with self._lock:
+            return len(self.unlinked)
+
+    def _link(self, rows: np.ndarray, vectors: np.ndarray, alive: np.ndarray):
+        similarity = vectors[rows] @ vectors.T
+        similarity[:, ~alive] = -np.inf
+        similarity[np.arange(len(rows)), rows] = -np.inf
+        count = min(self.count, similarity.shape[1] - 1)
+        if count > 0:
+            nearest = np.argpartition(-similarity, count - 1, axis=1)[:, :count]
+            scores = np.take_along_axis(similarity, nearest, axis=1)
+            order = np.argsort(-scores, axis=1, kind="stable")
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            scores = np.take_along_axis(scores, order, axis=1)
+            nearest[np.isinf(scores)] = -1
+        with self._lock:
+            for i, row in enumerate(rows.tolist()):
+                self.neighbours[row] = -1
+                self.scores[row] = -np.inf
+                if count > 0:
+                    self.neighbours[row, :count] = nearest[i]
+                    self.scores[row, :count] = scores[i]
+                self.linked[row] = True
+                self.unlinked.discard(row)
+                self.dirty.add(row)
+            # Join the lists of linked stories this one is nearer to than their furthest neighbour
+            size = similarity.shape[1]
+            furthest = self.scores[:size, -1]
+            linked = self.linked[:size]
+            for i, row in enumerate(rows.tolist()):
+                for other in np.flatnonzero((similarity[i] > furthest) & linked).tolist():
+                    if other == row or row in self.neighbours[other]:
+                        continue
+                    self.neighbours[other, -1] = row
+                    self.scores[other, -1] = similarity[i, other]
+                    order = np.argsort(-self.scores[other], kind="stable")
+                    self.neighbours[other] = self.neighbours[other][order]
+                    self.scores[other] = self.scores[other][order]
+                    self.dirty.add(other)
+
+    def related(self, row: int) -> list:
+        """Returns the (id, score) pairs of a linked row's live neighbours, nearest first"""
+        with self._lock:
+            return [
+                (self.ids[other], float(score))
+                for other, score in zip(self.neighbours[row].tolist(), self.scores[row].tolist())
+                if other >= 0 and score > 0 and self.alive[other]
+            ]
+
+    def changes(self) -> tuple:
+        """Takes the neighbour lists changed since the last call, and the ids of stories removed"""
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+            removed, self.removed = self.removed, []
+            lists = {}
+            for row in dirty:
+                if self.alive[row]:
+                    neighbours = [
+                        (other, score)
+                        for other, score in zip(self.neighbours[row].tolist(), self.scores[row].tolist())
+                        if other >= 0
+                    ]
+                    lists[self.ids[row]] = (
+                        [self.ids[other] for other, _ in neighbours],
+                        [score for _, score in neighbours],
+                    )
+            return lists, removed
+
+
+class RelatedIndexes(CorpusIndexes):
+    """
+    RelatedIndex for each instance, with the neighbour lists stored in a
+    "related.<collection>" collection as {_id, related, scores}, so finding
+    them for every story only ever happens once.
+
+    Stories added are linked by a background task a batch at a time, and the
+    lists it changes are written back after each batch.
+    """
+
+    def __init__(self):
+        super().__init__(RelatedIndex, {"content": 1, "tokenised": 1})
+        self._locks_linking = {}
+        self._linkers = {}
+        self._instances = {}
+
+    def _store(self, instance):
+        return instance.collection.database[f"related.{instance.collection.name}"]
+
+    async def _built(self, instance, index):
+        await asyncio.to_thread(index.freeze)
+        cursor = self._store(instance).find({}).batch_size(1000)
+        while batch := await cursor.to_list(1000):
+            await asyncio.to_thread(index.restore, batch)
+
+    async def _build(self, instance):
+        self._instances[instance.collection.name] = instance
+        index = await super()._build(instance)
+        self._kick(instance, index)
+        return index
+
+    def _changed(self, name: str, index):
+        self._kick(self._instances[name], index)
+
+    def _kick(self, instance, index):
+        name = instance.collection.name
+        running = self._linkers.get(name)
+        if running is not None and running[0] is index and not running[1].done():
+            return
+        task = asyncio.ensure_future(self._link(instance, index))
+        task.add_done_callback(self._linked)
+        self._linkers[name] = (index, task)
+
+    def _linked(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Failed to find related stories: {task.exception()!r}")
+
+    async def _update(self, instance, index, rows=None):
+        async with self._locks_linking.setdefault(instance.collection.name, asyncio.Lock()):
+            await asyncio.to_thread(index.update, rows)
+        lists, removed = index.changes()
+        if lists or removed:
+            await self._store(instance).bulk_write(
+                [ReplaceOne({"_id": story_id}, {"related": related, "scores": scores}, upsert=True)
+                 for story_id, (related, scores) in lists.items()]
+                + [DeleteOne({"_id": story_id}) for story_id in removed],
+                ordered=False,
+            )
+
+    async def _link(self, instance, index):
+        while index.pending:
+            await self._update(instance, index)
+
+    async def related(self, instance, story_id) -> list | None:
+        """
+        Returns the (id, score) pairs of a story's nearest stories, finding them
+        now if the background task hasn't yet, or None if there is no such story.
+        """
+        index = await self.get(instance)
+        row = index.rows.get(story_id)
+        if row is None:
+            # Perhaps written by another process since the index was built
+            story = await instance.collection.find_one({"_id": story_id}, self.projection)
+            if story is None:
+                return None
+            self._apply(instance.collection.name, "add_many", [story])
+            row = index.rows[story_id]
+        if not index.is_linked(row):
+            await self._update(instance, index, [row])
+        return index.related(row)
+
+
+related_indexes = RelatedIndexes()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import threading
+
+from caching import DiskStore, SizedLRU
+from ilo import sitelen_to_bytes
+
+SITELEN_FONT = os.environ.get("SITELEN_FONT")
+
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+
+class RenderCache:
+    """
+    Content addressed cache of rendered sitelen pona images.
+
+    Images are keyed by a hash of everything that affects the output, kept as
+    bytes in a size-bounded LRU and optionally in a size-bounded directory.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 32 * 1024 * 1024,
+        directory: str = None,
+        max_disk_bytes: int = 512 * 1024 * 1024,
+    ):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = SizedLRU(max_bytes)
+        self._disk = DiskStore(directory, max_disk_bytes) if directory is not None else None
+        # Loaded fonts are shared, and FreeType faces aren't safe to use from
+        # several threads at once
+        self._render_lock = threading.Lock()
+
+    @staticmethod
+    def key(sitelen: str, format: str = "png", font_path: str = SITELEN_FONT, **options) -> str:
+        """Returns the hex digest identifying a render"""
+        description = json.dumps(
+            [sitelen, format, font_path, sorted(options.items())], ensure_ascii=False
+        )
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def render(
+        self, sitelen: str, format: str = "png", font_path: str = SITELEN_FONT, **options
+    ) -> tuple:
+        """
+        Renders sitelen pona, or returns the cached render.
+
+        Takes the arguments of ilo.render_sitelen, plus the image format.
+
+        Returns:
+            tuple: The render's digest and the encoded image bytes.
+        """
+        digest = self.key(sitelen, format, font_path, **options)
+        key = f"{digest[:2]}/{digest}.{format}"
+        data = self._memory.get(key)
+        if data is not None:
+            self.hits += 1
+            return digest, data
+
+        if self._disk is not None:
+            data = self._disk.get(key)
+            if data is not None:
+                self._memory.put(key, data)
+                self.disk_hits += 1
+                return digest, data
+
+        self.misses += 1
+        with self._render_lock:
+            data = sitelen_to_bytes(sitelen, format=format, font_path=font_path, **options)
+        self._memory.put(key, data)
+        if self._disk is not None:
+            self._disk.put(key, data)
+        return digest, data
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._memory),
+            "bytes": self._memory.nbytes,
+            "disk_bytes": self._disk.nbytes if self._disk is not None else 0,
+        }
+
+
+render_cache = RenderCache(
+    max_bytes=int(os.environ.get("RENDER_CACHE_BYTES", 32 * 1024 * 1024)),
+    directory=os.environ.get("RENDER_CACHE_DIR"),
+    max_disk_bytes=int(os.environ.get("RENDER_CACHE_DISK_BYTES", 512 * 1024 * 1024)),
+)
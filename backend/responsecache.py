@@ -0,0 +1,80 @@
+import hashlib
+import os
+import threading
+import time
+
+from caching import SizedLRU
+
+
+class ResponseCache:
+    """
+    Cache of serialized API responses, grouped by namespace (a story collection).
+
+    Entries expire after ttl seconds and the least recently used are evicted past
+    max_bytes. Invalidating a namespace bumps its generation, so every response
+    cached for it is missed from then on without touching other namespaces.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl: float = 60):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = SizedLRU(max_bytes, sizeof=lambda entry: len(entry[1]))
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, namespace: str) -> int:
+        return self._generations.get(namespace, 0)
+
+    def _key(self, namespace: str, key, generation: int = None) -> tuple:
+        if generation is None:
+            generation = self.generation(namespace)
+        return (namespace, generation, key)
+
+    def get(self, namespace: str, key):
+        """Returns the (etag, body, headers) cached for key, or None"""
+        entry = self._entries.get(self._key(namespace, key))
+        if entry is None or entry[3] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[:3]
+
+    def put(self, namespace: str, key, body: bytes, headers: dict = None, generation: int = None) -> tuple:
+        """
+        Caches a response body and returns its (etag, body, headers).
+
+        Pass the generation read before building the body: if the namespace was
+        invalidated meanwhile, the entry goes under the old generation and is
+        never served.
+        """
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        entry = (etag, body, headers or {}, time.monotonic() + self.ttl)
+        self._entries.put(self._key(namespace, key, generation), entry)
+        return entry[:3]
+
+    def invalidate(self, namespace: str):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self._entries.nbytes,
+        }
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """True if an If-None-Match header matches the etag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024)),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 60)),
+)
@@ -0,0 +1,373 @@
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from corpus import CorpusIndexes
+from ilo import LEXICON
+from importing import stored_tokens
+
+# Words, and runs of anything else; punctuation between words breaks a phrase
+TEXT_RE = re.compile(r"[A-Za-z]+|[^\sA-Za-z]+")
+QUERY_RE = re.compile(r'"([^"]*)"|\[([^\]]*)\]|(\S+)')
+# Stories fetched per round trip when checking phrases of three or more words
+VERIFY_BATCH_SIZE = 100
+# Share of doc numbers that may be tombstones before the postings are compacted
+COMPACT_DEAD_FRACTION = 0.25
+# Tombstones always allowed, so small indexes aren't compacted on every edit
+COMPACT_MIN_DEAD = 1024
+
+EMPTY = np.empty(0, dtype=np.uint32)
+
+
+def walk(tokens: list, lexicon=LEXICON):
+    """
+    Yields ("word", word) for each word of a story's tokens in canonical
+    spelling, ("name", name) for each name, and ("break", None) wherever a
+    phrase can't continue: punctuation, names, escapes and markdown.
+    """
+    for token in tokens:
+        if token["type"] in ("tokipona", "illegal"):
+            for text in TEXT_RE.findall(token["content"]):
+                if text[0].isalpha():
+                    yield "word", lexicon.canonical(text.lower())
+                else:
+                    yield "break", None
+        elif token["type"] == "name":
+            yield "break", None
+            yield "name", token["content"]["name"].strip().lower()
+            yield "break", None
+        else:
+            yield "break", None
+
+
+def story_terms(tokens: list, lexicon=LEXICON) -> tuple:
+    """Returns the word and name counts of a story, and the set of its adjacent word pairs"""
+    words, names, pairs = Counter(), Counter(), set()
+    previous = None
+    for kind, value in walk(tokens, lexicon):
+        if kind == "word":
+            words[value] += 1
+            if previous is not None:
+                pairs.add((previous, value))
+            previous = value
+        else:
+            if kind == "name":
+                names[value] += 1
+            previous = None
+    return words, names, pairs
+
+
+def parse_query(query: str, lexicon=LEXICON) -> list:
+    """
+    Parses a search query into groups of terms, any one group of which a story
+    must match in full.
+
+    Words are ANDed, OR separates groups, "quoted words" are a phrase and
+    [Name] is a name. Terms are ("word", word), ("name", name) or
+    ("phrase", [words]).
+    """
+    groups = [[]]
+    for phrase, name, word in QUERY_RE.findall(query):
+        if word == "OR":
+            groups.append([])
+        elif name:
+            groups[-1].append(("name", name.strip().lower()))
+        else:
+            words = [
+                lexicon.canonical(text.lower())
+                for text in TEXT_RE.findall(phrase or word) if text[0].isalpha()
+            ]
+            if len(words) == 1:
+                groups[-1].append(("word", words[0]))
+            elif words:
+                groups[-1].append(("phrase", words))
+    return [group for group in groups if group]
+
+
+def needs_verifying(groups: list) -> bool:
+    """True if the query has a phrase the word pair postings can't match exactly"""
+    return any(kind == "phrase" and len(value) > 2 for group in groups for kind, value in group)
+
+
+def matches(groups: list, tokens: list, lexicon=LEXICON) -> bool:
+    """Checks a query against a story's tokens directly"""
+    sequence = list(walk(tokens, lexicon))
+    words = {value for kind, value in sequence if kind == "word"}
+    names = {value for kind, value in sequence if kind == "name"}
+
+    def has_phrase(phrase):
+        size = len(phrase)
+        return any(
+            all(sequence[i + j] == ("word", word) for j, word in enumerate(phrase))
+            for i in range(len(sequence) - size + 1)
+        )
+
+    def has(term):
+        kind, value = term
+        if kind == "word":
+            return value in words
+        if kind == "name":
+            return value in names
+        return has_phrase(value)
+
+    return any(all(has(term) for term in group) for group in groups)
+
+
+class Postings:
+    """The stories a term occurs in, as ascending doc numbers, and how often"""
+
+    __slots__ = ("docs", "counts")
+
+    def __init__(self):
+        self.docs = array("I")
+        self.counts = array("I")
+
+
+def _intersect(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Both sorted: look up each of the shorter array's entries in the longer one
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return EMPTY
+    positions = np.searchsorted(b, a)
+    positions[positions == len(b)] = 0
+    return a[b[positions] == a]
+
+
+class SearchIndex:
+    """
+    An inverted index over a collection's stories.
+
+    Each story gets a doc number in the order it was added, so every posting
+    list is an ascending array of doc numbers, stored as a compact uint32
+    array and searched with NumPy. Words and names have separate postings with
+    term frequencies; adjacent word pairs have postings of their own for
+    phrases. A story that is edited or deleted keeps its old doc number as a
+    tombstone until more than COMPACT_DEAD_FRACTION of them are, when the
+    postings are compacted.
+
+    add_many and remove_many may be called from another thread while
+    searching.
+
+    Args:
+        lexicon (ilo.Lexicon): Spells words canonically, e.g. ale for ali.
+    """
+
+    def __init__(self, lexicon=LEXICON):
+        self.lexicon = lexicon
+        self.ids = []
+        self.docnos = {}
+        self.alive = bytearray()
+        self.lengths = array("I")
+        self.words = {}
+        self.names = {}
+        self.pairs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.docnos)
+
+    def _post(self, postings: dict, term, docno: int, count: int):
+        entry = postings.get(term)
+        if entry is None:
+            entry = postings[term] = Postings()
+        entry.docs.append(docno)
+        entry.counts.append(count)
+
+    def add_many(self, stories: list):
+        """Indexes stories, replacing any that are already indexed"""
+        for story in stories:
+            tokens = stored_tokens(story)
+            terms = story_terms(tokens, self.lexicon) if tokens else None
+            with self._lock:
+                self._remove(story["_id"])
+                if terms is not None:
+                    self._add(story["_id"], *terms)
+        self._compact_if_needed()
+
+    def _add(self, story_id, words: Counter, names: Counter, pairs: set):
+        docno = len(self.ids)
+        self.ids.append(story_id)
+        self.docnos[story_id] = docno
+        self.alive.append(1)
+        self.lengths.append(max(1, sum(words.values()) + sum(names.values())))
+        for word, count in words.items():
+            self._post(self.words, word, docno, count)
+        for name, count in names.items():
+            self._post(self.names, name, docno, count)
+        for pair in pairs:
+            entry = self.pairs.get(pair)
+            if entry is None:
+                entry = self.pairs[pair] = array("I")
+            entry.append(docno)
+
+    def _remove(self, story_id):
+        docno = self.docnos.pop(story_id, None)
+        if docno is not None:
+            self.alive[docno] = 0
+
+    def remove_many(self, story_ids: list):
+        with self._lock:
+            for story_id in story_ids:
+                self._remove(story_id)
+        self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        dead = len(self.ids) - len(self.docnos)
+        if dead > max(COMPACT_MIN_DEAD, COMPACT_DEAD_FRACTION * len(self.ids)):
+            self.compact()
+
+    def compact(self):
+        """Drops the tombstones, renumbering live stories in the order they were added"""
+        with self._lock:
+            alive = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+            # Doc numbers only ever shrink, so every posting list stays ascending
+            renumber = (np.cumsum(alive) - 1).astype(np.uint32)
+
+            def squeeze(docs: array, counts: array = None) -> tuple:
+                docs = np.frombuffer(docs, dtype=np.uint32)
+                keep = alive[docs]
+                if not keep.any():
+                    return None, None
+                kept = array("I", renumber[docs[keep]].tobytes())
+                if counts is None:
+                    return kept, None
+                return kept, array("I", np.frombuffer(counts, dtype=np.uint32)[keep].tobytes())
+
+            for postings in (self.words, self.names):
+                for term, entry in list(postings.items()):
+                    entry.docs, entry.counts = squeeze(entry.docs, entry.counts)
+                    if entry.docs is None:
+                        del postings[term]
+            for pair, docs in list(self.pairs.items()):
+                docs, _ = squeeze(docs)
+                if docs is None:
+                    del self.pairs[pair]
+                else:
+                    self.pairs[pair] = docs
+            self.ids = [story_id for story_id, live in zip(self.ids, alive.tolist()) if live]
+            self.docnos = {story_id: docno for docno, story_id in enumerate(self.ids)}
+            self.alive = bytearray(b"\x01") * len(self.ids)
+            self.lengths = array("I", np.frombuffer(self.lengths, dtype=np.uint32)[alive].tobytes())
+
+    def _postings(self, term) -> Postings | None:
+        kind, value = term
+        return (self.words if kind == "word" else self.names).get(value)
+
+    def _docs(self, term) -> np.ndarray:
+        kind, value = term
+        if kind == "phrase":
+            docs = None
+            for pair in zip(value, value[1:]):
+                entry = self.pairs.get(pair)
+                if entry is None:
+                    return EMPTY
+                pair_docs = np.frombuffer(entry, dtype=np.uint32)
+                docs = pair_docs if docs is None else _intersect(docs, pair_docs)
+            return docs.copy()
+        postings = self._postings(term)
+        if postings is None:
+            return EMPTY
+        # Copied so the arrays aren't locked against appends by a live view
+        return np.frombuffer(postings.docs, dtype=np.uint32).copy()
+
+    def _score(self, docs: np.ndarray, group: list) -> np.ndarray:
+        # Sum of tf-idf over the group's words and names, tf by story length
+        scores = np.zeros(len(docs))
+        lengths = np.frombuffer(self.lengths, dtype=np.uint32)[docs]
+        total = max(1, len(self))
+        for kind, value in group:
+            terms = [("word", word) for word in value] if kind == "phrase" else [(kind, value)]
+            for term in terms:
+                postings = self._postings(term)
+                posted = np.frombuffer(postings.docs, dtype=np.uint32)
+                counts = np.frombuffer(postings.counts, dtype=np.uint32)
+                idf = math.log(1 + total / len(posted))
+                scores += counts[np.searchsorted(posted, docs)] / lengths * idf
+        return scores
+
+    def search(self, groups: list, limit: int = None) -> tuple:
+        """
+        Finds the live stories matching parsed query groups.
+
+        Phrases of three or more words match stories holding each adjacent pair
+        of them, which check with matches before trusting.
+
+        Args:
+            limit (int, optional): Number of best stories to return; all of them if None.
+
+        Returns:
+            tuple: The number of stories found, their ids best first and their scores.
+        """
+        with self._lock:
+            return self._search(groups, limit)
+
+    def _search(self, groups: list, limit: int = None) -> tuple:
+        matched, scored = [], []
+        alive = np.frombuffer(self.alive, dtype=np.uint8)
+        for group in groups:
+            # Rarest terms first keeps the intersections small
+            docs = None
+            for term_docs in sorted((self._docs(term) for term in group), key=len):
+                docs = term_docs if docs is None else _intersect(docs, term_docs)
+                if not len(docs):
+                    break
+            docs = docs[alive[docs] == 1]
+            if len(docs):
+                matched.append(docs)
+                scored.append(self._score(docs, group))
+        if not matched:
+            return 0, [], []
+        if len(matched) == 1:
+            docs, scores = matched[0], scored[0]
+        else:
+            docs, inverse = np.unique(np.concatenate(matched), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(scored))
+        if limit is not None and limit < len(docs):
+            # Only the best limit need sorting
+            best = np.argpartition(-scores, limit - 1)[:limit]
+            order = best[np.argsort(-scores[best], kind="stable")]
+        else:
+            order = np.argsort(-scores, kind="stable")
+        return len(docs), [self.ids[docno] for docno in docs[order].tolist()], scores[order].tolist()
+
+
+search_indexes = CorpusIndexes(SearchIndex, {"content": 1, "tokenised": 1})
+
+
+async def search_stories(instance, query: str, skip: int = 0, limit: int = 20) -> tuple:
+    """
+    Searches an instance's stories.
+
+    Returns:
+        tuple: The number of stories found, and (id, score) pairs for the
+        requested page of them, best first. When the query has phrases of three
+        or more words, the number is an upper bound.
+    """
+    groups = parse_query(query, instance.lexicon)
+    index = await search_indexes.get(instance)
+    if not needs_verifying(groups):
+        total, story_ids, scores = index.search(groups, skip + limit)
+        return total, list(zip(story_ids, scores))[skip:]
+    # Check candidates best first, only as far as the requested page
+    total, story_ids, scores = index.search(groups)
+    found = []
+    for start in range(0, len(story_ids), VERIFY_BATCH_SIZE):
+        batch = story_ids[start : start + VERIFY_BATCH_SIZE]
+        stories = {
+            story["_id"]: story
+            async for story in instance.collection.find({"_id": {"$in": batch}}, {"content": 1, "tokenised": 1})
+        }
+        for story_id, score in zip(batch, scores[start : start + VERIFY_BATCH_SIZE]):
+            story = stories.get(story_id)
+            if story is not None and matches(groups, stored_tokens(story), instance.lexicon):
+                found.append((story_id, score))
+        if len(found) >= skip + limit:
+            break
+    else:
+        return len(found), found[skip : skip + limit]
+    return total, found[skip : skip + limit]
@@ -0,0 +1,79 @@
+import base64
+from datetime import datetime
+
+import orjson
+
+from ilo import decode_tokens, encode_tokens
+
+
+def _token(token: dict) -> dict:
+    content = token["content"]
+    if isinstance(content, dict):
+        content = {"name": content["name"], "toki_name": content.get("toki_name")}
+    elif not isinstance(content, str):
+        raise TypeError(f"Unexpected token content {content!r}")
+    return {"type": token["type"], "content": content}
+
+
+class DocumentEncoder:
+    """
+    Turns MongoDB story documents straight into the JSON a pydantic model would
+    produce for them, without constructing or validating the model.
+
+    Documents are trusted to have the shape the write endpoints and importer
+    store. Any document whose dates or tokens are not what they store is
+    serialized through the model instead, so the output always matches it.
+
+    Tokens are written as the model's list of tokens, or with token_format
+    "compact" as the base64 of ilo.encode_tokens over the story's content.
+
+    Args:
+        model (type): The pydantic model whose JSON output to reproduce.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = [field for field in model.model_fields if field != "id"]
+
+    def _tokens(self, story: dict, token_format: str):
+        tokens = story.get("tokenised")
+        if token_format == "compact":
+            if isinstance(tokens, list):
+                try:
+                    tokens = encode_tokens(tokens, story["content"])
+                except (ValueError, KeyError):
+                    pass
+            if isinstance(tokens, bytes):
+                return base64.b64encode(tokens).decode("ascii")
+        elif isinstance(tokens, bytes):
+            tokens = decode_tokens(tokens, story["content"])
+        if tokens is not None:
+            tokens = [_token(token) for token in tokens]
+        return tokens
+
+    def document(self, story: dict, token_format: str = "legacy") -> dict:
+        """Returns a story document as JSON-ready values, in the model's field order"""
+        data = {"id": str(story["_id"])}
+        try:
+            for field in self.fields:
+                value = story.get(field)
+                if field == "date":
+                    if isinstance(value, datetime):
+                        value = value.isoformat() + "Z"
+                    elif value is not None:
+                        raise TypeError(f"Unexpected date {value!r}")
+                elif field == "tokenised":
+                    value = self._tokens(story, token_format)
+                data[field] = value
+        except (KeyError, TypeError):
+            story = {k: v for k, v in story.items() if k != "_id"}
+            if isinstance(story.get("tokenised"), bytes):
+                story["tokenised"] = decode_tokens(story["tokenised"], story["content"])
+            return orjson.loads(self.model(id=data["id"], **story).model_dump_json())
+        return data
+
+    def encode(self, story: dict, token_format: str = "legacy") -> bytes:
+        return orjson.dumps(self.document(story, token_format))
+
+    def encode_many(self, stories: list, token_format: str = "legacy") -> bytes:
+        return orjson.dumps([self.document(story, token_format) for story in stories])
@@ -0,0 +1,283 @@
+import json
+import random
+import re
+import time
+from pathlib import Path
+
+import pytest
+
+import ilo
+
+STORIES = Path(__file__).parent.parent / "stories.json"
+
+
+def old_markdown(content: str, lexicon=ilo.LEXICON) -> list:
+    """The markdown handling the tokenizer replaced, rendering with the markdown package"""
+    markdown = pytest.importorskip("markdown")
+    content = content.replace("\n\n", "\nPARAGRAPH_BREAK")
+    markdown_text = markdown.markdown(content, extensions=["tables"]).replace("<p>", "").replace("</p>", "")
+    markdown_text = re.sub(r"(<br */?>)", r"", markdown_text)
+    if "<" not in markdown_text:
+        return ilo._preprocess(content, lexicon)
+    markdown_text = re.sub(r"(</h[1-3]>)\n", r"\1", markdown_text)
+    toks = []
+    for part in markdown_text.split("<"):
+        if len(part) == 0:
+            continue
+        try:
+            tag, text = part.split(">")
+        except ValueError:
+            tag, text = "", part
+        if len(tag) > 0:
+            toks.append({"type": "markdown", "content": tag})
+        toks += ilo._preprocess(text, lexicon)
+    return toks
+
+
+def old_scan(content: str, lexicon=ilo.LEXICON) -> list:
+    """The character by character scanner _preprocess replaced, checking words against lexicon"""
+    tokens = []
+    token_type = "tokipona"
+    output = ""
+
+    i = 0
+    while i < len(content):
+        c = content[i]
+        rest = content[i:]
+        if c in "[{":
+            token_type = "tokipona"
+            tokens.append((token_type, output))
+            if c == "[":
+                if "]" in rest:
+                    output = rest[1 : rest.index("]")]
+                    i += len(output) + 2
+                    tokens.append(("name", ilo.split_fancy_names(output, lexicon)))
+                else:
+                    token_type = "error"
+                    tokens.append((token_type, rest))
+                    break
+            elif c == "{":
+                if "}" in rest:
+                    output = rest[1 : rest.index("}")]
+                    tokens.append(("escaped", output))
+                    i += len(output) + 2
+                else:
+                    token_type = "error"
+                    tokens.append((token_type, rest))
+                    break
+            output, token_type = "", "tokipona"
+            continue
+
+        next_word = re.match(r"[\w]+", rest)
+        if next_word is not None:
+            w = next_word[0]
+            if w in ilo.UNORTHODOXIES:
+                w = ilo.UNORTHODOXIES[w]
+            i += len(w)
+            if re.match(r".*[A-Z].*", w):
+                tokens.append((token_type, output))
+                output, token_type = "", "tokipona"
+                tokens.append(("name", {"name": w}))
+            elif not lexicon.is_legal(w):
+                tokens.append((token_type, output))
+                tokens.append(("illegal", w))
+                token_type = "tokipona"
+                output = ""
+            else:
+                output += w
+        else:
+            output += c
+            i += 1
+
+    if len(output) > 0:
+        tokens.append((token_type, output))
+
+    last_tok = None
+    buffer = []
+    for tok in tokens:
+        if tok[0] in ["tokipona", "illegal", "escaped", "name"] and last_tok == tok[0]:
+            if last_tok == "name" and tok[1].get("toki_name") is not None:
+                buffer[-1] = (
+                    tok[0],
+                    {"name": buffer[-1][1]["name"] + tok[1]["name"], "toki_name": tok[1]["toki_name"]},
+                )
+            else:
+                buffer[-1] = (tok[0], buffer[-1][1] + tok[1])
+        else:
+            buffer.append(tok)
+        last_tok = tok[0]
+
+    final_buffer = []
+    for tok in buffer:
+        if tok[0] in ["tokipona", "illegal", "escaped"] and tok[1].strip() == "":
+            if final_buffer and final_buffer[-1][0] in ["tokipona", "illegal", "escaped"]:
+                final_buffer[-1] = (final_buffer[-1][0], final_buffer[-1][1] + tok[1])
+            elif final_buffer and final_buffer[-1][0] == "name":
+                final_buffer[-1][1]["name"] += tok[1]
+            else:
+                final_buffer.append(tok)
+        else:
+            final_buffer.append(tok)
+    return [{"type": tok[0], "content": tok[1]} for tok in final_buffer]
+
+
+def text_fragments(seed: int, count: int) -> list:
+    """Generates text mixing words, names, escapes, stray brackets and punctuation"""
+    rng = random.Random(seed)
+    pieces = [
+        *"aeioujklmnpstw", *" .,!?\n", "[", "]", "{", "}", "|", "_", "3", "é",
+        "Sonja", "ali", "ale", "toki", "pona", "xyz", " jan ", "[jan Sonja|sonja]", "[a|toki pona]", "{x}",
+    ]
+    return ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 30))) for _ in range(count)]
+
+
+def markdown_blocks(seed: int, count: int) -> list:
+    """Generates well-formed markdown blocks of every kind the tokenizer handles"""
+    rng = random.Random(seed)
+    words = "mi sina ona toki pona li e la pi".split()
+    marks = ["*{}*", "**{}**", "_{}_", "`{}`", "[jan Sonja]", "{{x}}", "[{}](https://a.b)", "![{}](c.png)", "***{}***"]
+
+    def phrase():
+        out = []
+        for _ in range(rng.randint(1, 6)):
+            word = rng.choice(words)
+            if rng.random() < 0.3:
+                word = rng.choice(marks).format(f"{word} {rng.choice(words)}")
+            out.append(word)
+        return " ".join(out)
+
+    def lines(prefix, most=3):
+        return "\n".join(prefix(i) + phrase() for i in range(rng.randint(1, most)))
+
+    kinds = [
+        lambda: lines(lambda i: ""),
+        lambda: "#" * rng.randint(1, 6) + " " + phrase(),
+        lambda: phrase() + "\n" + rng.choice("=-") * rng.randint(2, 5),
+        lambda: lines(lambda i: rng.choice("*-+") + " "),
+        lambda: lines(lambda i: f"{i + 1}. "),
+        lambda: lines(lambda i: "> "),
+        lambda: rng.choice(["***", "---", "___", "* * *"]),
+        lambda: lines(lambda i: "    "),
+        lambda: "a | b\n--- | :---:\n" + "\n".join(f"{phrase()} | {phrase()}" for _ in range(rng.randint(1, 2))),
+        lambda: f"# {phrase()}\n{phrase()}",
+        lambda: f"{phrase()}\n***\n{phrase()}",
+        lambda: f"{phrase()}\n> {phrase()}",
+        lambda: f"- {phrase()}\n# {phrase()}",
+    ]
+    return [rng.choice(kinds)() for _ in range(count)]
+
+
+def test_scanner_matches_old_on_stories():
+    for story in json.loads(STORIES.read_text()):
+        assert ilo._preprocess(story["content"]) == old_scan(story["content"])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_scanner_matches_old_on_generated(seed):
+    for content in text_fragments(seed, 5000):
+        assert ilo._preprocess(content) == old_scan(content), content
+
+
+def test_iter_tokens_matches_scanner():
+    for content in text_fragments(3, 500):
+        chunks = [content[i : i + 7] for i in range(0, len(content), 7)]
+        assert list(ilo.iter_tokens(chunks)) == ilo._preprocess(content), content
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "toki\n***\npona",
+        "* * *",
+        "mi toki\n===\njan pona\n---\nsona",
+        "x\n---\n- i",
+        "o `toki` pona",
+        "a `b` `` c`d `` e",
+        "```\ncode\n```",
+        "> toki pona\n> mi jan",
+        "a\n> q\nb",
+        "> q\n> # h\n> *e*",
+        "    code here\n    more\npona",
+        "mi *toki **pona** li* pona",
+        "***a***",
+        "a *b\nc* d",
+        "[a](b) *[c *d*](e)*",
+        "- i\n***",
+        "- i\n# h",
+        "- a\n- b\nc",
+        "a | b\n--- | :---:\nc | d\ne | f",
+    ],
+)
+def test_markdown_matches_old(content):
+    assert ilo.preprocess(content) == old_markdown(content)
+
+
+def test_markdown_matches_old_on_stories():
+    # Compared a paragraph at a time, the old path garbling blank lines
+    for story in json.loads(STORIES.read_text()):
+        for paragraph in story["content"].split("\n\n"):
+            assert ilo.preprocess(paragraph) == old_markdown(paragraph), paragraph
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_markdown_matches_old_on_generated(seed):
+    for content in markdown_blocks(seed, 1000):
+        assert ilo.preprocess(content) == old_markdown(content), content
+
+
+@pytest.mark.parametrize(
+    "content, tail",
+    [
+        # Blank lines are kept as text rather than turning into PARAGRAPH_BREAK names
+        ("mi toki.\n\nsina toki.", [{"type": "tokipona", "content": "mi toki.\n\nsina toki."}]),
+        # Emphasis pairs up as in CommonMark, inside words too
+        (
+            "mi *ona**li",
+            [
+                {"type": "tokipona", "content": "mi "},
+                {"type": "markdown", "content": "em"},
+                {"type": "tokipona", "content": "ona"},
+                {"type": "markdown", "content": "/em"},
+                {"type": "tokipona", "content": "*li"},
+            ],
+        ),
+        # Code spans need a closing run of as many backticks
+        ("mi` toki``", [{"type": "tokipona", "content": "mi` toki``"}]),
+        # A table ends at the first line without a pipe
+        (
+            "a | b\n--|--\nc | d\ne",
+            [{"type": "markdown", "content": "/table"}, {"type": "tokipona", "content": "\ne"}],
+        ),
+        # A blockquote after a list item follows the list rather than nesting in it
+        (
+            "- i\n> q",
+            [
+                {"type": "markdown", "content": "/ul"},
+                {"type": "tokipona", "content": "\n"},
+                {"type": "markdown", "content": "blockquote"},
+                {"type": "tokipona", "content": "\n"},
+                {"type": "illegal", "content": "q\n"},
+                {"type": "markdown", "content": "/blockquote"},
+            ],
+        ),
+    ],
+)
+def test_markdown_differs_from_old(content, tail):
+    tokens = ilo.preprocess(content)
+    assert tokens != old_markdown(content)
+    assert tokens[-len(tail) :] == tail
+
+
+@pytest.mark.parametrize("unit, count", [("*a ", 10000), ("_a ", 10000), ("[", 100000), ("` ", 10000), ("[a](b ", 5000)])
+def test_markdown_is_linear(unit, count):
+    # Unclosed emphasis, brackets and backticks used to rescan the rest of the line, taking quadratic time
+    def best_time(content):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            ilo.preprocess(content)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    # Twice the input takes twice as long if linear and four times as long if quadratic
+    assert best_time(unit * 2 * count) < 3 * best_time(unit * count)
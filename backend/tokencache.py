@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+from caching import DiskStore, SizedLRU
+from ilo import LEXICON, Lexicon, preprocess, preprocess_many
+
+
+def content_hash(content: str) -> str:
+    """Returns the hex sha256 of a story's content"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """
+    Cache of tokenized content keyed by (content hash, tokenizer version), where
+    the version also covers any extra words in the lexicon used.
+
+    Entries are kept as JSON text in an in-process LRU that is bounded by size,
+    and optionally in a directory on disk that survives restarts.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, directory: str = None):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = SizedLRU(max_bytes)
+        self._disk = DiskStore(directory) if directory is not None else None
+
+    def get(self, digest: str, lexicon: Lexicon = LEXICON):
+        """Returns the cached tokens for a content hash, or None"""
+        key = f"{lexicon.version}/{digest[:2]}/{digest}.json"
+        text = self._memory.get(key)
+        if text is not None:
+            self.hits += 1
+            return json.loads(text)
+
+        if self._disk is not None:
+            data = self._disk.get(key)
+            if data is not None:
+                text = data.decode("utf-8")
+                self._memory.put(key, text)
+                self.disk_hits += 1
+                return json.loads(text)
+
+        self.misses += 1
+        return None
+
+    def put(self, digest: str, tokens: list, lexicon: Lexicon = LEXICON):
+        """Stores the tokens for a content hash"""
+        key = f"{lexicon.version}/{digest[:2]}/{digest}.json"
+        text = json.dumps(tokens, ensure_ascii=False)
+        self._memory.put(key, text)
+        if self._disk is not None:
+            self._disk.put(key, text.encode("utf-8"))
+
+    def preprocess(self, content: str, digest: str = None, lexicon: Lexicon = LEXICON) -> list:
+        """Tokenizes content, using the cache where possible"""
+        if digest is None:
+            digest = content_hash(content)
+        tokens = self.get(digest, lexicon)
+        if tokens is None:
+            tokens = preprocess(content, lexicon)
+            self.put(digest, tokens, lexicon)
+        return tokens
+
+    def preprocess_many(self, contents, digests=None, lexicon: Lexicon = LEXICON) -> list:
+        """Tokenizes many contents, sending only the cache misses to preprocess_many"""
+        contents = list(contents)
+        if digests is None:
+            digests = [content_hash(content) for content in contents]
+        results = [self.get(digest, lexicon) for digest in digests]
+        missing = [i for i, tokens in enumerate(results) if tokens is None]
+        tokenised = preprocess_many([contents[i] for i in missing], lexicon=lexicon)
+        for i, tokens in zip(missing, tokenised):
+            self.put(digests[i], tokens, lexicon)
+            results[i] = tokens
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._memory),
+            "bytes": self._memory.nbytes,
+            "max_bytes": self._memory.max_bytes,
+            "tokenizer_version": LEXICON.version,
+        }
+
+
+token_cache = TokenCache(
+    max_bytes=int(os.environ.get("TOKEN_CACHE_BYTES", 64 * 1024 * 1024)),
+    directory=os.environ.get("TOKEN_CACHE_DIR"),
+)
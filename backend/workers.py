@@ -0,0 +1,120 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class WorkerPool:
+    """
+    Runs CPU-bound work for async handlers in a process or thread pool, so it
+    doesn't hold up the event loop.
+
+    At most max_pending tasks are queued or running at once; past that, run
+    raises PoolSaturated straight away instead of queueing more. A task that
+    takes longer than its timeout raises TaskTimeout in the caller. A timed out
+    task can't be interrupted, so it keeps its place until it finishes.
+
+    Args:
+        kind (str): "process" or "thread".
+        workers (int, optional): Pool size. Defaults to the CPU count.
+        max_pending (int): Tasks allowed in the pool at once.
+        timeout (float): Default seconds to wait for a task.
+    """
+
+    def __init__(self, kind: str = "process", workers: int = None, max_pending: int = 32, timeout: float = 30):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Unknown pool kind {kind!r}")
+        self.kind = kind
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                # Spawned rather than forked: the API process runs threads (Motor's,
+                # the image pool) that a fork would copy mid-operation
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="workers")
+        return self._executor
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    async def run(self, func, *args, timeout: float = None):
+        """
+        Runs func(*args) in the pool and returns its result.
+
+        Raises:
+            PoolSaturated: If max_pending tasks are already in the pool.
+            TaskTimeout: If the task takes longer than timeout seconds.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PoolSaturated("Too many tasks waiting for a worker")
+            self.pending += 1
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            with self._lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(self._release)
+        try:
+            # shield keeps the timeout from cancelling the underlying future
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(future)), timeout or self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TaskTimeout(f"Task took longer than {timeout or self.timeout} seconds")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+
+# Tokenizing and summarizing for API requests
+tokenize_pool = WorkerPool(
+    kind=os.environ.get("TOKENIZE_POOL", "process"),
+    workers=int(os.environ.get("TOKENIZE_WORKERS", 0)) or None,
+    max_pending=int(os.environ.get("TOKENIZE_MAX_PENDING", 32)),
+    timeout=float(os.environ.get("TOKENIZE_TIMEOUT", 30)),
+)